@@ -6,49 +6,73 @@ import time
 import sys
 import functools
 import base64
+import json
 import os
 import threading
 import weakref
 import logging
+import queue
+import select
 from typing import Optional
-from subprocess import PIPE, STDOUT
+from subprocess import PIPE, STDOUT, TimeoutExpired
 from subprocess import Popen
 from scullery import workers
 from .jsonrpyc import RPC
+from .shm_ring import ShmRing
+from . import sched_tools
 
 
-# Truly an awefullehaccken
-# Break out of venv to get to gstreamer
-# It's just that one package.  Literally everything else
-# Is perfectly fine. GStreamer doesn't do pip so we do this.
-
-try:
-    if os.environ.get("VIRTUAL_ENV"):
-        en = os.environ["VIRTUAL_ENV"]
-        p = os.path.join(
-            en,
-            "lib",
-            "python" + ".".join(sys.version.split(".")[:2]),
-            "site-packages",
-            "gi",
-        )
-
-        s = "/usr/lib/python3/dist-packages/gi"
-        if os.path.exists(s) and (not os.path.exists(p)):
-            os.symlink(s, p)
-except Exception:
-    logging.exception("Failed to do the gstreamer hack")
+@functools.cache
+def break_out_of_venv():
+    """Truly an awefullehaccken
+    Break out of venv to get to gstreamer
+    It's just that one package.  Literally everything else
+    Is perfectly fine. GStreamer doesn't do pip so we do this.
 
+    Only the background process needs gi, so this runs before the first one starts, not at import."""
+    try:
+        if os.environ.get("VIRTUAL_ENV"):
+            en = os.environ["VIRTUAL_ENV"]
+            p = os.path.join(
+                en,
+                "lib",
+                "python" + ".".join(sys.version.split(".")[:2]),
+                "site-packages",
+                "gi",
+            )
 
-try:
-    for i in sys.path:
-        if "uv/tools" in i:
-            p = os.path.join(i, "gi")
             s = "/usr/lib/python3/dist-packages/gi"
             if os.path.exists(s) and (not os.path.exists(p)):
                 os.symlink(s, p)
-except Exception:
-    logging.exception("Failed to do the gstreamer hack")
+    except Exception:
+        logging.exception("Failed to do the gstreamer hack")
+
+    try:
+        for i in sys.path:
+            if "uv/tools" in i:
+                p = os.path.join(i, "gi")
+                s = "/usr/lib/python3/dist-packages/gi"
+                if os.path.exists(s) and (not os.path.exists(p)):
+                    os.symlink(s, p)
+    except Exception:
+        logging.exception("Failed to do the gstreamer hack")
+
+
+def wait_for_exit(p: Popen, timeout: float) -> bool:
+    "Wait up to timeout for p to exit, woken by the kernel the moment it does where pidfds exist"
+    try:
+        fd = os.pidfd_open(p.pid)
+    except (AttributeError, OSError):
+        try:
+            p.wait(timeout)
+        except TimeoutExpired:
+            return False
+        return True
+    try:
+        select.select([fd], [], [], timeout)
+    finally:
+        os.close(fd)
+    return p.poll() is not None
 
 
 def close_fds(p: Popen):
@@ -104,6 +128,8 @@ class ElementProxy:
         # This was making a bad GC loop issue.
         self.parent = weakref.ref(parent)
         self.id = obj_id
+        # The id in the first server process, what the construction log uses
+        self.origin_id = obj_id
 
     def get_property(self, p, max_wait=10) -> str | int | float | bool:
         x = self.parent()
@@ -125,10 +151,405 @@ class ElementProxy:
         assert x
         return x.pull_to_file(self.id, f)
 
+    def push_bytes(self, data, timeout=None) -> bool:
+        "For appsrc elements.  Send one buffer through shared memory, False if it timed out waiting for room."
+        x = self.parent()
+        assert x
+        return x.push_shm(self, data, timeout)
+
+    def push_array(self, a, timeout=None) -> bool:
+        "For appsrc elements.  Send an array, like a NumPy video frame or block of samples, as one buffer."
+        m = memoryview(a)
+        if not m.c_contiguous:
+            m = memoryview(m.tobytes())
+        return self.push_bytes(m, timeout)
+
+
+class Recorder(ElementProxy):
+    "Proxy to a pre-trigger recorder in the server, see GStreamerPipeline.add_pretrigger_recorder"
+
+    def __init__(self, parent: GstreamerPipeline, obj_id) -> None:
+        super().__init__(parent, obj_id)
+        self.finished = queue.Queue()
+
+    def trigger(self, filename: str) -> str:
+        """Start writing the buffered pre-roll and then live video to filename.
+        If already recording, cancels any pending release and returns the current file."""
+        x = self.parent()
+        assert x
+        return x.rpc_call(
+            "trigger_recording", args=(self.id, filename), block=0.0001, timeout=10
+        )
+
+    def release(self):
+        "Stop after the post-roll, the file is done when it shows up in finished"
+        x = self.parent()
+        assert x
+        x.rpc_call("release_recording", args=(self.id,), block=0.0001, timeout=10)
+
+    def stats(self) -> dict:
+        x = self.parent()
+        assert x
+        return x.rpc_call(
+            "get_recorder_stats", args=(self.id,), block=0.0001, timeout=10
+        )
+
+
+class AudioTap:
+    """Reads float32 sample blocks that the server writes into a shared memory ring.
+    Holds at most max_blocks, if you fall behind the server drops new blocks and counts overruns."""
+
+    def __init__(self, ring: ShmRing, block_size: int, channels: int, dtype="float32"):
+        self.ring = ring
+        self.block_size = block_size
+        self.channels = channels
+        self.dtype = dtype
+        self.id = None
+        # Overruns as last reported by the server
+        self.overruns = 0
+        self._event = threading.Event()
+        self.closed = False
+
+    def _on_data(self, overruns):
+        self.overruns = overruns
+        self._event.set()
+
+    def read(self, timeout=None, latest=True):
+        """Return the next block as a (block_size, channels) array, or None on timeout.
+        With latest, older blocks are discarded, so you get the freshest audio, at most one block old
+        when read.  Without it you get every block, but up to max_blocks old if you fall behind."""
+        import numpy as np
+
+        t = time.monotonic()
+        while not self.closed:
+            if latest:
+                while self.ring.queued() > 1:
+                    self.ring.advance()
+
+            v = self.ring.peek()
+            if v is not None:
+                a = np.frombuffer(v, dtype=np.float32).copy()
+                v.release()
+                self.ring.advance()
+                a = a.reshape(-1, self.channels)
+                if self.dtype != "float32":
+                    a = a.astype(self.dtype)
+                return a
+
+            self._event.clear()
+            # Ring may have been filled between peek and clear
+            if self.ring.queued():
+                continue
+
+            remaining = None
+            if timeout is not None:
+                remaining = timeout - (time.monotonic() - t)
+                if remaining <= 0:
+                    return None
+            self._event.wait(0.5 if remaining is None else min(remaining, 0.5))
+        return None
+
+    def __iter__(self):
+        while not self.closed:
+            a = self.read()
+            if a is not None:
+                yield a
+
+    def close(self):
+        self.closed = True
+        self._event.set()
+        self.ring.close()
+
 
 pipes = weakref.WeakValueDictionary()
 
 
+def read_cpu_times() -> dict[int, tuple[int, int]]:
+    "CPU number -> (busy, total) jiffies from /proc/stat"
+    times = {}
+    with open("/proc/stat") as f:
+        for line in f:
+            if line.startswith("cpu") and line[3].isdigit():
+                name, *fields = line.split()
+                v = [int(i) for i in fields]
+                # idle and iowait
+                idle = v[3] + (v[4] if len(v) > 4 else 0)
+                times[int(name[3:])] = (sum(v) - idle, sum(v))
+    return times
+
+
+class PlacementManager:
+    """Gives each iceflow background process its own set of CPUs, chosen by declared workload and
+    per core load, so heavy video doesn't land on the same cores as audio.
+
+    Pass it to GStreamerPipeline(placement=manager, workload="video"), or set
+    icemedia.iceflow.default_placement to use it for every pipeline.
+    Per role cpus from set_scheduling() take precedence inside a process."""
+
+    # Relative cost and how many cores a process of each kind gets
+    WORKLOADS = {
+        "audio": (1.0, 1),
+        "video": (4.0, 2),
+        "analysis": (2.0, 1),
+    }
+
+    # Audio and video on one core is what we are trying to avoid
+    CONFLICTS = {("audio", "video"), ("video", "audio")}
+
+    def __init__(self, cpus: Optional[list[int]] = None, idle_threshold: float = 0.02):
+        self.cpus = sorted(cpus or os.sched_getaffinity(0))
+        # Below this fraction of one core, a process counts as idle and may be moved
+        self.idle_threshold = idle_threshold
+        self.lock = threading.RLock()
+        # pid -> placement info
+        self.placements: dict[int, dict] = {}
+        self._cpu_times = read_cpu_times()
+        self._load = {i: 0.0 for i in self.cpus}
+
+    def _update_load(self):
+        now = read_cpu_times()
+        for cpu in self.cpus:
+            if cpu in now and cpu in self._cpu_times:
+                busy = now[cpu][0] - self._cpu_times[cpu][0]
+                total = now[cpu][1] - self._cpu_times[cpu][1]
+                if total > 0:
+                    self._load[cpu] = busy / total
+        self._cpu_times = now
+
+    def _prune(self):
+        for pid, p in list(self.placements.items()):
+            pipeline = p["pipeline"]()
+            if not pipeline or pipeline.ended or pipeline.worker.poll() is not None:
+                del self.placements[pid]
+
+    def _choose(self, workload: str, exclude: Optional[int] = None) -> list[int]:
+        weight, count = self.WORKLOADS[workload]
+        assigned = {i: 0.0 for i in self.cpus}
+        kinds: dict[int, set] = {i: set() for i in self.cpus}
+        for pid, p in self.placements.items():
+            if pid == exclude:
+                continue
+            for cpu in p["cpus"]:
+                if cpu in assigned:
+                    assigned[cpu] += p["weight"] / len(p["cpus"])
+                    kinds[cpu].add(p["workload"])
+
+        def score(cpu):
+            conflict = any((workload, i) in self.CONFLICTS for i in kinds[cpu])
+            return (conflict, self._load[cpu] + 0.25 * assigned[cpu], cpu)
+
+        return sorted(sorted(self.cpus, key=score)[:count])
+
+    def _apply(self, pid: int, cpus: list[int]):
+        for tid in sched_tools.thread_ids(pid):
+            sched_tools.apply(tid, cpus=cpus)
+
+    def place(self, pipeline: GStreamerPipeline, workload: str = "audio") -> list[int]:
+        "Pick CPUs for the pipeline's background process and pin all of its threads there"
+        if workload not in self.WORKLOADS:
+            raise ValueError("Unknown workload: " + workload)
+        with self.lock:
+            self._prune()
+            self._update_load()
+            pid = pipeline.worker.pid
+            cpus = self._choose(workload)
+            self.placements[pid] = {
+                "pipeline": weakref.ref(pipeline),
+                "workload": workload,
+                "weight": self.WORKLOADS[workload][0],
+                "cpus": cpus,
+                "cpu_time": self._process_cpu_time(pid),
+                "checked": time.monotonic(),
+            }
+            self._apply(pid, cpus)
+            return cpus
+
+    def release(self, pipeline: GStreamerPipeline):
+        with self.lock:
+            if pipeline.worker:
+                self.placements.pop(pipeline.worker.pid, None)
+
+    def _process_cpu_time(self, pid: int) -> float:
+        return sum(i["cpu_time"] for i in sched_tools.thread_stats(pid))
+
+    def rebalance(self) -> list[int]:
+        """Move idle processes to whatever cores are now best for them.
+        Busy ones stay put, moving them costs more than it gains.  Returns the moved pids."""
+        moved = []
+        with self.lock:
+            self._prune()
+            self._update_load()
+            for pid, p in self.placements.items():
+                now = time.monotonic()
+                cpu_time = self._process_cpu_time(pid)
+                usage = (cpu_time - p["cpu_time"]) / max(now - p["checked"], 0.001)
+                p["cpu_time"] = cpu_time
+                p["checked"] = now
+                p["usage"] = usage
+
+                if usage < self.idle_threshold:
+                    cpus = self._choose(p["workload"], exclude=pid)
+                    if cpus != p["cpus"]:
+                        p["cpus"] = cpus
+                        self._apply(pid, cpus)
+                        moved.append(pid)
+        return moved
+
+    def placement_map(self) -> dict:
+        "pid -> workload, weight, CPUs and recent usage in cores, plus current load per CPU"
+        with self.lock:
+            self._prune()
+            return {
+                "processes": {
+                    pid: {
+                        k: v for k, v in p.items() if k not in ("pipeline", "checked")
+                    }
+                    for pid, p in self.placements.items()
+                },
+                "load": dict(self._load),
+            }
+
+
+# Shorthands for GStreamerPipeline(profile=...), anything else is used as GST_TRACERS directly
+PROFILE_TRACERS = {
+    True: "latency(flags=pipeline+element)",
+    "latency": "latency(flags=pipeline+element)",
+    "proctime": "latency(flags=element);proctime",
+}
+
+
+def fold_profile(profile: dict, root: str = "pipeline", metric: str = "total") -> str:
+    """Turn get_profile() output into folded stacks.  Elements go under the end to end paths
+    whose source or sink they are, or under "other" otherwise"""
+    lines = []
+    paths = list(profile.get("paths", {}))
+    children = {}
+    for element, h in profile.get("elements", {}).items():
+        v = h.get(metric) or 0
+        parent = "other"
+        for i in paths:
+            if element in i.split("->"):
+                parent = i
+                break
+        children[parent] = children.get(parent, 0) + v
+        lines.append(f"{root};{parent};{element} {int(v * 10**6)}")
+
+    # Folded stacks want self time, the elements under a path already count toward it
+    for path, h in profile.get("paths", {}).items():
+        v = max((h.get(metric) or 0) - children.get(path, 0), 0)
+        lines.append(f"{root};{path} {int(v * 10**6)}")
+    return "\n".join(lines) + "\n"
+
+
+def remap_ids(v, ids: dict):
+    "Replace any ints in v that are keys of ids, through lists, tuples and dicts"
+    if isinstance(v, bool):
+        return v
+    if isinstance(v, int):
+        return ids.get(v, v)
+    if isinstance(v, (list, tuple)):
+        return type(v)(remap_ids(i, ids) for i in v)
+    if isinstance(v, dict):
+        return {i: remap_ids(j, ids) for i, j in v.items()}
+    return v
+
+
+def makeProcessWatcher(selfref):
+    """Fails over to the standby or rebuilds the pipeline if its process dies, without keeping it alive.
+    While waiting it keeps track of the position, so a standby knows where to pick up."""
+
+    def watcher():
+        while True:
+            self = selfref()
+            if self is None or self.ended:
+                return
+            worker = self.worker
+            del self
+
+            # Returns as soon as the process dies, the timeout only paces position updates
+            if not wait_for_exit(worker, 0.5):
+                self = selfref()
+                if self and self._standby and self._started:
+                    try:
+                        position = self.rpc_call(
+                            "getPosition", block=0.001, timeout=0.5
+                        )
+                        self._position_anchor = (position, time.monotonic())
+                    except Exception:
+                        pass
+                del self
+                continue
+
+            self = selfref()
+            # Replaced meanwhile, by a rebuild or a failover
+            if self is None or self.ended or self.worker is not worker:
+                continue
+            try:
+                if self._standby:
+                    self.failover("process died")
+                elif self._watchdog_rebuild:
+                    self.rebuild("process died")
+                else:
+                    return
+            except Exception:
+                logging.exception("Could not recover pipeline")
+                return
+            del self
+
+    return watcher
+
+
+def makeMirrorWorker(selfref, q):
+    """Repeats calls on the standby in the order they were made on the primary, so the caller
+    never waits on the twin.  An Event in the queue is set when everything before it is done."""
+
+    def mirror():
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+            self = selfref()
+            if self is None:
+                return
+            twin, method, args, kwargs, result = item
+            if twin is not self._standby:
+                del self
+                continue
+            try:
+                r = twin.rpc_call(
+                    method,
+                    args=remap_ids(args, self._standby_ids),
+                    kwargs=remap_ids(kwargs, self._standby_ids),
+                    block=0.0001,
+                    timeout=10,
+                )
+                if isinstance(result, int) and not isinstance(result, bool) and r:
+                    self._standby_ids[result] = r
+            except Exception:
+                logging.exception("Standby out of sync, replacing it")
+                with self._rebuild_lock:
+                    if self._standby is twin:
+                        self._standby = None
+                        twin.stop()
+                        threading.Thread(
+                            target=self._spawn_standby, daemon=True
+                        ).start()
+            del self
+
+    return mirror
+
+
+# Used by any pipeline not given a placement manager of its own
+default_placement: Optional[PlacementManager] = None
+
+# Every background process sees the same plugin registry, so these are fetched once and shared
+_element_names: Optional[set[str]] = None
+_element_descriptions: dict[str, dict] = {}
+
+
 class GStreamerPipeline:
     def __init__(self, *a, **k):
         self.ended = False
@@ -136,20 +557,103 @@ class GStreamerPipeline:
         self.lock = threading.RLock()
 
         self.error_info_handlers = []
+        self.placement: Optional[PlacementManager] = None
+
+        # Frame stream id -> (fmt, max_fps), and the bounded queues of everyone iterating it
+        self._frame_streams = {}
+        self._frame_subscribers = {}
+        self._frame_lock = threading.Lock()
+
+        # Element ID -> (ShmRing, server side feeder ID)
+        self._shm_rings = {}
+        self._shm_lock = threading.Lock()
+
+        self._audio_taps = {}
+
+        self._meter_subscribers = []
+        self._meter_lock = threading.Lock()
 
         # If del can't find this it would to an infinite loop
         self.worker: Optional[Popen] = None
+        self._ready = threading.Event()
+        # Seconds to each step of the server's startup, and "total" from spawning to ready
+        self.startup_profile = {}
+
+        # Everything that built the pipeline, replayed to rebuild it in a fresh process.
+        # (method, args, kwargs, result), with ids as they were in the first process.
+        self._construction_log = []
+        # (element, property) -> args and kwargs of the latest set_property
+        self._property_log = {}
+        # Compositor -> args of the latest set_compositor_layout since its last new input
+        self._layout_log = {}
+        # Current server side id -> id in the first process
+        self._id_origin = {}
+        self._proxies = weakref.WeakSet()
+        self._started = False
+        # Calls that changed the graph but can't be replayed, see _not_replayable
+        self._unreplayable = []
+        self._rebuild_lock = threading.RLock()
+        self.recovery_stats = []
+        self._watchdog_thread = None
+        self._watchdog_config = None
+        self._watchdog_rebuild = False
+
+        # Hot standby twin, see enable_standby()
+        self._init_args = (a, k)
+        self._standby: Optional[GStreamerPipeline] = None
+        # First process id -> id in the standby
+        self._standby_ids = {}
+        # Last known (position, monotonic time) for the standby to pick up from
+        self._position_anchor = None
+        # Calls waiting to be repeated on the standby, see makeMirrorWorker
+        self._mirror_queue = queue.Queue()
+        self._mirror_thread = None
 
         pipes[id(self)] = self
-        f = os.path.join(
-            os.path.dirname(os.path.abspath(__file__)), "iceflow_server.py"
-        )
 
         env = {}
         env.update(os.environ)
         env["GST_DEBUG"] = "*:1"
 
+        # Constructor args the server side pipeline uses, passed on its command line
+        config = dict(zip(("name", "realtime", "system_time"), a))
+        config.update(k)
+        config = {
+            i: config[i] for i in ("name", "realtime", "system_time") if i in config
+        }
+
+        self._name = config.get("name") or "pipeline"
+
+        # Tracers have to be in the environment before GStreamer starts up
+        profile = k.get("profile")
+        if profile:
+            env["GST_TRACERS"] = PROFILE_TRACERS.get(profile, profile)
+            env["GST_DEBUG"] = "*:1,GST_TRACER:7"
+            # The records are read through a log function, the default handler is removed
+            # once that is installed, this only covers anything logged before then
+            env["GST_DEBUG_FILE"] = os.devnull
+            config["profile"] = True
+
+        self._config = config
+        self._env = env
         self.rpc = None
+        self._spawn()
+
+        self.placement = k.get("placement") or default_placement
+        self._workload = k.get("workload", "audio")
+        if self.placement:
+            self.placement.place(self, self._workload)
+
+    def _spawn(self):
+        "Start a background process and connect to it"
+        f = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "iceflow_server.py"
+        )
+        env = self._env
+        config = self._config
+        break_out_of_venv()
+        self._ready.clear()
+        t = time.monotonic()
 
         if which("kaithem._iceflow_server") and False:
             self.worker = Popen(
@@ -164,7 +668,7 @@ class GStreamerPipeline:
             for i in range(5):
                 try:
                     self.worker = Popen(
-                        [sys.executable or "python3", f],
+                        [sys.executable or "python3", f, json.dumps(config)],
                         stdout=PIPE,
                         stdin=PIPE,
                         stderr=STDOUT,
@@ -184,9 +688,284 @@ class GStreamerPipeline:
             stdout=self.worker.stdin,
             daemon=True,
         )
-        # We have no way of knowing when it's actually ready and listening for commands if gstreamer
-        # needs to load
-        time.sleep(1)
+        # The server says when GStreamer is loaded and it's listening for commands
+        if not self._ready.wait(15):
+            logging.warning(
+                "Iceflow server did not say it was ready, continuing anyway"
+            )
+        self.startup_profile["total"] = time.monotonic() - t
+
+    def _on_ready(self, profile):
+        "Called by the server once it can take commands, with seconds to each step of its startup"
+        self.startup_profile = dict(profile)
+        self._ready.set()
+
+    def _to_origin(self, v):
+        "Replace current server ids in v with first process ids, for the construction log"
+        return remap_ids(v, self._id_origin)
+
+    def _record(self, method, args, kwargs, result):
+        args = self._to_origin(tuple(args))
+        kwargs = self._to_origin(dict(kwargs))
+        if isinstance(result, int) and not isinstance(result, bool):
+            self._id_origin.setdefault(result, result)
+        result = self._to_origin(result)
+        with self._rebuild_lock:
+            self._construction_log.append((method, args, kwargs, result))
+            self._mirror(method, args, kwargs, result)
+
+    def _not_replayable(self, method):
+        """For calls with state in this process that a rebuild can't recreate.  Without them in the log
+        a rebuilt graph would be wired differently, so they and recovery exclude each other."""
+        if self._watchdog_rebuild or self._standby:
+            raise RuntimeError(
+                f"{method} can't be rebuilt, not usable with rebuild or a standby"
+            )
+        self._unreplayable.append(method)
+
+    def _check_replayable(self):
+        if self._unreplayable:
+            raise RuntimeError(
+                f"Pipeline used {', '.join(self._unreplayable)}, which can't be rebuilt"
+            )
+
+    def _mirror(self, method, args, kwargs, result=None):
+        "Queue the same call for the standby, args having first process ids"
+        twin = self._standby
+        if not twin:
+            return
+        self._mirror_queue.put((twin, method, args, kwargs, result))
+        if not self._mirror_thread:
+            self._mirror_thread = threading.Thread(
+                target=makeMirrorWorker(weakref.ref(self), self._mirror_queue),
+                daemon=True,
+                name="nostartstoplog.MirrorWorker",
+            )
+            self._mirror_thread.start()
+
+    def _sync_mirror(self, timeout=2):
+        "Wait for the standby to have every call queued so far"
+        if not self._mirror_thread:
+            return
+        done = threading.Event()
+        self._mirror_queue.put(done)
+        done.wait(timeout)
+
+    def enable_standby(self):
+        """Keep a twin of this pipeline in a second process, built from the same calls and prerolled
+        in PAUSED.  If this one's process dies or stalls, the twin seeks to where this one should be
+        and takes over.  Costs a second process and the memory of a paused pipeline."""
+        self._check_replayable()
+        if any(i[0] == "publishStreamRemote" for i in self._construction_log):
+            raise RuntimeError(
+                "Only one process can publish a stream, not usable with a standby"
+            )
+        if not self._standby:
+            self._spawn_standby()
+        self._ensure_watcher()
+
+    def _spawn_standby(self):
+        if self.ended:
+            return
+        a, k = self._init_args
+        # The base class, a subclass constructor would add its elements a second time
+        twin = GStreamerPipeline(*a, **k)
+        with self._rebuild_lock:
+            self._standby_ids = self._replay_into(twin)
+            self._standby = twin
+            if self._started:
+                twin.rpc_call("prepare", block=0.0001, timeout=10)
+
+    def failover(self, reason: str = "manual") -> float:
+        """Switch to the standby, seeking it to where this pipeline should be now.  Then a
+        new standby is started.  Returns the seconds from being called to the twin playing."""
+        t = time.monotonic()
+        with self._rebuild_lock:
+            twin = self._standby
+            if not twin:
+                return self.rebuild(reason)
+            self._sync_mirror()
+            self._standby = None
+
+            if self._started:
+                expected = 0.0
+                if self._position_anchor:
+                    position, at = self._position_anchor
+                    expected = position + time.monotonic() - at
+                twin.rpc_call("prepare", args=(expected,), block=0.0001, timeout=10)
+                twin.rpc_call("go", block=0.0001, timeout=10)
+            gap = time.monotonic() - t
+
+            # Take over the twin's process
+            if self.placement:
+                self.placement.release(self)
+            old_worker, old_rpc = self.worker, self.rpc
+            self.worker, self.rpc = twin.worker, twin.rpc
+            self.rpc.target = weakref.proxy(self)
+            twin.worker = None
+            twin.rpc = None
+            twin.ended = True
+            self._adopt_ids(self._standby_ids)
+
+            for i in (old_worker.terminate, old_worker.kill):
+                try:
+                    i()
+                except Exception:
+                    pass
+            close_fds(old_worker)
+            try:
+                old_rpc.stdin.close()
+            except Exception:
+                pass
+            workers.do(old_worker.wait)
+
+            if self.placement:
+                self.placement.place(self, self._workload)
+            if self._watchdog_config:
+                self.rpc_call(
+                    "set_watchdog", args=self._watchdog_config, block=0.0001, timeout=10
+                )
+
+        self._on_recovery("failover:" + reason, gap)
+        threading.Thread(target=self._spawn_standby, daemon=True).start()
+        return gap
+
+    def _ensure_watcher(self):
+        if not self._watchdog_thread:
+            self._watchdog_thread = threading.Thread(
+                target=makeProcessWatcher(weakref.ref(self)),
+                daemon=True,
+                name="nostartstoplog.IceflowWatchdog",
+            )
+            self._watchdog_thread.start()
+
+    def rebuild(self, reason: str = "manual") -> float:
+        """Replace the background process with a fresh one and replay every call that built the
+        pipeline, then start it if it was started.  ElementProxy objects are remapped and keep working.
+        Not possible after add_audio_tap or add_frame_stream.  Returns the time it took in seconds."""
+        self._check_replayable()
+        t = time.monotonic()
+        with self._rebuild_lock:
+            old_worker, old_rpc = self.worker, self.rpc
+            self._close_all_shm_rings()
+            self._close_audio_taps()
+            if self.placement:
+                self.placement.release(self)
+
+            self._spawn()
+            if self.placement:
+                self.placement.place(self, self._workload)
+            for i in (old_worker.terminate, old_worker.kill):
+                try:
+                    i()
+                except Exception:
+                    pass
+            close_fds(old_worker)
+            try:
+                old_rpc.stdin.close()
+            except Exception:
+                pass
+            workers.do(old_worker.wait)
+
+            self._adopt_ids(self._replay_into(self))
+
+            if self._watchdog_config:
+                self.rpc_call(
+                    "set_watchdog", args=self._watchdog_config, block=0.0001, timeout=10
+                )
+            if self._started:
+                self.rpc_call("start", block=0.0001, timeout=10)
+
+        seconds = time.monotonic() - t
+        self._on_recovery("rebuild:" + reason, seconds)
+        return seconds
+
+    def _replay_into(self, pipe: GStreamerPipeline) -> dict:
+        """Run the construction log and latest properties against pipe's process.
+        Returns first process ids -> ids in that process."""
+        new_ids = {}
+        for method, args, kwargs, result in list(self._construction_log):
+            r = pipe.rpc_call(
+                method,
+                args=remap_ids(args, new_ids),
+                kwargs=remap_ids(kwargs, new_ids),
+                block=0.0001,
+                timeout=10,
+            )
+            if isinstance(result, int) and not isinstance(result, bool):
+                new_ids[result] = r
+
+        for args, kwargs in list(self._property_log.values()):
+            pipe.rpc_call(
+                "set_property",
+                args=remap_ids(args, new_ids),
+                kwargs=remap_ids(kwargs, new_ids),
+                block=0.0001,
+                timeout=10,
+            )
+
+        for args in list(self._layout_log.values()):
+            pipe.rpc_call(
+                "set_compositor_layout",
+                args=remap_ids(args, new_ids),
+                block=0.0001,
+                timeout=10,
+            )
+        return new_ids
+
+    def _adopt_ids(self, new_ids: dict):
+        "Point proxies at a new process, given first process ids -> new ids"
+        self._id_origin = {v: k for k, v in new_ids.items()}
+        for i in self._proxies:
+            i.id = new_ids.get(i.origin_id, i.id)
+
+    def enable_watchdog(
+        self, timeout: float = 5.0, restart: bool = True, rebuild: bool = True
+    ):
+        """Restart the pipeline if no buffers reach a sink for timeout seconds while PLAYING.
+        With rebuild set, if the background process dies or can't recover, a fresh one is
+        built from the construction log.  Recovery times go to on_recovery and recovery_stats."""
+        if rebuild:
+            self._check_replayable()
+        self._watchdog_config = (timeout, restart)
+        self.rpc_call(
+            "set_watchdog", args=self._watchdog_config, block=0.0001, timeout=10
+        )
+        self._watchdog_rebuild = rebuild
+        if rebuild:
+            self._ensure_watcher()
+
+    def _on_stall(self, diagnostics):
+        self.on_stall(diagnostics)
+        if self._standby:
+            # Faster than waiting for the restart
+            threading.Thread(target=self.failover, args=("stall",), daemon=True).start()
+
+    def on_stall(self, diagnostics):
+        "Subclass this to see stalls, with state, position, queue levels and how long nothing flowed"
+        logging.warning(f"Iceflow pipeline stalled: {diagnostics}")
+
+    def _on_unrecoverable(self, diagnostics):
+        logging.error(f"Iceflow pipeline could not recover, rebuilding: {diagnostics}")
+        if self._standby:
+            threading.Thread(
+                target=self.failover, args=("unrecoverable",), daemon=True
+            ).start()
+        elif self._watchdog_rebuild:
+            # Not in the RPC thread, it's about to go away
+            threading.Thread(
+                target=self.rebuild, args=("unrecoverable",), daemon=True
+            ).start()
+
+    def _on_recovery(self, kind, seconds):
+        self.recovery_stats.append(
+            {"kind": kind, "seconds": seconds, "time": time.time()}
+        )
+        self.recovery_stats = self.recovery_stats[-100:]
+        self.on_recovery(kind, seconds)
+
+    def on_recovery(self, kind, seconds):
+        "Subclass this to get recovery times, kind is restart, rebuild:reason or failover:reason"
 
     def rpc_call(self, *a, **k):
         if self.rpc:
@@ -200,7 +979,18 @@ class GStreamerPipeline:
 
         def f(*a, **k):
             try:
-                return self.rpc_call(attr, args=a, kwargs=k, block=0.001, timeout=15)
+                r = self.rpc_call(attr, args=a, kwargs=k, block=0.001, timeout=15)
+                # Anything that adds to the pipeline is needed to rebuild it
+                if attr.startswith("add"):
+                    self._record(attr, a, k, r)
+                elif attr in ("start", "play", "go", "sync_start"):
+                    if not self._started:
+                        self._position_anchor = (0.0, time.monotonic())
+                    self._started = True
+                    self._mirror("prepare", (), {})
+                elif attr == "seek" and a and a[0] is not None:
+                    self._position_anchor = (a[0], time.monotonic())
+                return r
             except Exception:
                 if self.worker:
                     for i in self.error_info_handlers:
@@ -228,7 +1018,205 @@ class GStreamerPipeline:
                 workers.do(self.worker.wait)
             raise
 
+    def add_app_source(
+        self, caps, framerate=None, max_bytes=4 * 1024 * 1024, is_live=False
+    ):
+        """Add a flow controlled appsrc.  Feed it with push_bytes or push_array on the returned proxy,
+        which block when the pipeline is not keeping up."""
+        if self.ended or self.worker.poll() is not None:
+            raise RuntimeError("This process is already dead")
+        a = (caps, framerate, max_bytes, is_live)
+        eid = self.rpc_call("addRemoteAppSource", args=a, block=0.0001, timeout=10)
+        # push_shm opens a new ring for the new id after a rebuild
+        self._record("addRemoteAppSource", a, {}, eid)
+        e = ElementProxy(self, eid)
+        self._proxies.add(e)
+        return e
+
+    def add_compositor(
+        self,
+        width=1280,
+        height=720,
+        framerate=None,
+        background="black",
+        connect_to_output=False,
+    ):
+        """Add a compositor mixing many video inputs into one output, in this one process.
+        Elements added next link to its output."""
+        if isinstance(connect_to_output, ElementProxy):
+            connect_to_output = connect_to_output.id
+        a = (width, height, framerate, background, connect_to_output)
+        eid = self.rpc_call("addCompositorRemote", args=a, block=0.0001, timeout=10)
+        self._record("addCompositorRemote", a, {}, eid)
+        e = ElementProxy(self, eid)
+        self._proxies.add(e)
+        return e
+
+    def add_compositor_input(self, compositor, source, grid=True) -> int:
+        "Feed a source element into the compositor, returns the input index"
+        if isinstance(compositor, ElementProxy):
+            compositor = compositor.id
+        if isinstance(source, ElementProxy):
+            source = source.id
+        a = (compositor, source, grid)
+        r = self.rpc_call("add_compositor_input", args=a, block=0.0001, timeout=10)
+        with self._rebuild_lock:
+            # The layout applied to the inputs before this one, so it is replayed before it too
+            layout = self._layout_log.pop(self._to_origin(compositor), None)
+            if layout:
+                self._construction_log.append(
+                    ("set_compositor_layout", layout, {}, None)
+                )
+            # The index isn't an id, don't let the rebuild log remap it
+            self._record("add_compositor_input", a, {}, None)
+        return r
+
+    def set_compositor_layout(self, compositor, layout=None, columns=None):
+        """Move inputs around with a list of (x, y, width, height), or an even grid if None.
+        Cheap enough to animate, it only sets pad properties."""
+        if isinstance(compositor, ElementProxy):
+            compositor = compositor.id
+        a = (compositor, layout, columns)
+        self.rpc_call("set_compositor_layout", args=a, block=0.0001, timeout=10)
+        # Like properties, only the latest layout matters for a rebuild
+        with self._rebuild_lock:
+            args = self._to_origin(a)
+            self._layout_log[args[0]] = args
+            self._mirror("set_compositor_layout", args, {})
+
+    def add_pretrigger_recorder(
+        self,
+        pre_roll=5.0,
+        post_roll=5.0,
+        max_bytes=64 * 1024 * 1024,
+        encoder="x264enc",
+        mux="matroskamux",
+        connect_to_output=None,
+    ) -> Recorder:
+        """Keep the last pre_roll seconds of encoded video in the background process's memory,
+        so a recording triggered by motion can include what happened before it."""
+        if isinstance(connect_to_output, ElementProxy):
+            connect_to_output = connect_to_output.id
+        a = (pre_roll, post_roll, max_bytes, encoder, mux, connect_to_output)
+        rid = self.rpc_call(
+            "addRemotePreTriggerRecorder", args=a, block=0.0001, timeout=10
+        )
+        self._record("addRemotePreTriggerRecorder", a, {}, rid)
+        r = Recorder(self, rid)
+        self._proxies.add(r)
+        return r
+
+    def _on_recording_done(self, rid, filename):
+        for i in self._proxies:
+            if isinstance(i, Recorder) and i.id == rid:
+                i.finished.put(filename)
+        self.on_recording_done(filename)
+
+    def on_recording_done(self, filename):
+        "Subclass this to know when a pre-trigger recording file is complete"
+
+    def publish_stream(self, name: str, connect_to_output=None, **kwargs):
+        """Share the data at this point with other iceflow processes under a name, through shared
+        memory, so one decode can feed many pipelines.  kwargs are shmsink properties."""
+        if self._standby:
+            raise RuntimeError(
+                "Only one process can publish a stream, not usable with a standby"
+            )
+        if isinstance(connect_to_output, ElementProxy):
+            connect_to_output = connect_to_output.id
+        k = dict(kwargs, connect_to_output=connect_to_output)
+        eid = self.rpc_call(
+            "publishStreamRemote", args=(name,), kwargs=k, block=0.0001, timeout=10
+        )
+        self._record("publishStreamRemote", (name,), k, eid)
+        e = ElementProxy(self, eid)
+        self._proxies.add(e)
+        return e
+
+    def subscribe_stream(self, name: str, timeout: float = 10):
+        """Add a source playing a stream published by another pipeline.  Waits up to timeout for it
+        to be published, and reconnects if the publisher restarts, calling on_stream_reconnect(name)."""
+        k = {"timeout": timeout}
+        eid = self.rpc_call(
+            "subscribeStreamRemote",
+            args=(name,),
+            kwargs=k,
+            block=0.0001,
+            timeout=timeout + 5,
+        )
+        self._record("subscribeStreamRemote", (name,), k, eid)
+        e = ElementProxy(self, eid)
+        self._proxies.add(e)
+        return e
+
+    def on_stream_reconnect(self, name):
+        "Subclass this to know when a subscribed stream's publisher came back"
+
+    def push_shm(self, element, data, timeout=None, slots=4) -> bool:
+        """Write a buffer into a shared memory ring read by the server, which pushes it into the appsrc.
+        The data never goes through JSON.  Blocks if all slots are full, returns False on timeout."""
+        if self.ended or self.worker.poll() is not None:
+            raise RuntimeError("This process is already dead")
+
+        if isinstance(element, ElementProxy):
+            element = element.id
+
+        n = memoryview(data).nbytes
+        started = time.monotonic()
+
+        with self._shm_lock:
+            ring, feeder = self._shm_rings.get(element, (None, None))
+
+            if ring is None or ring.slot_size < n:
+                if ring is not None:
+                    # Frames still in the old ring would be lost, let the server take them first
+                    self.rpc_call("shm_doorbell", args=(feeder,))
+                    if not ring.wait_empty(timeout):
+                        return False
+                    self._close_shm_ring(element)
+
+                # Some headroom so a slightly bigger buffer doesn't mean a new ring
+                ring = ShmRing.create(n + n // 8, slots)
+                try:
+                    feeder = self.rpc_call(
+                        "open_shm_source",
+                        args=(element, ring.name),
+                        block=0.0001,
+                        timeout=10,
+                    )
+                except Exception:
+                    ring.close()
+                    raise
+                self._shm_rings[element] = (ring, feeder)
+
+            if timeout is not None:
+                timeout = max(timeout - (time.monotonic() - started), 0)
+            if not ring.write(data, timeout):
+                return False
+
+        # Notification, no round trip
+        self.rpc_call("shm_doorbell", args=(feeder,))
+        return True
+
+    def _close_shm_ring(self, element):
+        ring, feeder = self._shm_rings.pop(element)
+        try:
+            self.rpc_call("close_shm_source", args=(feeder,))
+        except Exception:
+            pass
+        ring.close()
+
+    def _close_all_shm_rings(self):
+        with self._shm_lock:
+            for i in list(self._shm_rings):
+                self._close_shm_ring(i)
+
     def cleanup_popen(self):
+        # A standby that was promoted gave its process away
+        if not self.worker:
+            return
+        self._close_all_shm_rings()
+        self._close_audio_taps()
         self.worker.terminate()
         self.worker.kill()
         close_fds(self.worker)
@@ -238,6 +1226,8 @@ class GStreamerPipeline:
             pass
 
     def __del__(self):
+        if not self.worker:
+            return
         self.cleanup_popen()
         workers.do(self.worker.wait)
 
@@ -262,16 +1252,16 @@ class GStreamerPipeline:
                 (i.id if isinstance(i, ElementProxy) else i)
                 for i in k["connect_to_output"]
             ]
-        e = ElementProxy(
-            self,
-            self.rpc_call(
-                "add_elementRemote",
-                args=(element_name, *a),
-                kwargs=k,
-                block=0.0001,
-                timeout=5,
-            ),
+        eid = self.rpc_call(
+            "add_elementRemote",
+            args=(element_name, *a),
+            kwargs=k,
+            block=0.0001,
+            timeout=5,
         )
+        self._record("add_elementRemote", (element_name, *a), k, eid)
+        e = ElementProxy(self, eid)
+        self._proxies.add(e)
 
         name = k.get("name", f"{element_name}_{id(e)}")
 
@@ -287,6 +1277,36 @@ class GStreamerPipeline:
 
         return e
 
+    def list_elements(self) -> list[str]:
+        "Names of every element type the background process can make"
+        global _element_names
+        if _element_names is None:
+            _element_names = set(
+                self.rpc_call("list_elements", block=0.0001, timeout=10)
+            )
+        return sorted(_element_names)
+
+    def describe_element(self, element_name: str) -> dict:
+        "Class, pad templates, and properties with their types and defaults"
+        if element_name not in _element_descriptions:
+            _element_descriptions[element_name] = self.rpc_call(
+                "describe_element", args=(element_name,), block=0.0001, timeout=10
+            )
+        return _element_descriptions[element_name]
+
+    def validate_element(self, element_name: str, **props):
+        """Raise ValueError if the element type or any of the property names don't exist.
+        Only the first check of each type needs the background process."""
+        if element_name not in self.list_elements():
+            raise ValueError("Nonexistant element type: " + element_name)
+        known = self.describe_element(element_name)["properties"]
+        for i in props:
+            prop = i[1:] if i.startswith("_") else i
+            prop = prop.replace("_", "-")
+            # Child properties can't be checked without the element
+            if ":" not in prop and prop not in known:
+                raise ValueError(f"{element_name} has no property {prop}")
+
     def set_property(self, *a, max_wait=10, **k):
         # Probably Just Not Important enough to raise an error for this.
         if self.ended or self.worker.poll() is not None:
@@ -300,12 +1320,19 @@ class GStreamerPipeline:
                 k[key] = item.id
 
         a = [i.id if isinstance(i, ElementProxy) else i for i in a]
-        return ElementProxy(
-            self,
-            self.rpc_call(
-                "set_property", args=a, kwargs=k, block=0.0001, timeout=max_wait
-            ),
+        # Only the latest value of each property matters for a rebuild
+        # Locked so a standby being built either replays this or gets it mirrored
+        if len(a) >= 2:
+            with self._rebuild_lock:
+                args, kwargs = self._to_origin(tuple(a)), self._to_origin(dict(k))
+                self._property_log[(args[0], a[1])] = (args, kwargs)
+        r = self.rpc_call(
+            "set_property", args=a, kwargs=k, block=0.0001, timeout=max_wait
         )
+        if len(a) >= 2:
+            with self._rebuild_lock:
+                self._mirror("set_property", args, kwargs)
+        return ElementProxy(self, r)
 
     def get_property(self, e, p, max_wait=10):
         # Probably Just Not Important enough to raise an error for this.
@@ -322,18 +1349,203 @@ class GStreamerPipeline:
             "get_property", args=[e, p], block=0.0001, timeout=max_wait
         )
 
+    def scrub(self, t, accurate=False):
+        """Seek for UI scrubbers, without waiting for a reply.  The background process only keeps
+        the newest target, so a burst of calls never queues up. Uses fast keyframe seeks unless accurate."""
+        if self.ended or self.worker.poll() is not None:
+            return
+        self.rpc_call("scrub", args=(t, accurate))
+
+    def end_scrub(self, t=None):
+        "Call when the user lets go of the scrubber, for an accurate seek to t or the last scrub position"
+        if self.ended or self.worker.poll() is not None:
+            return
+        self.rpc_call("end_scrub", args=(t,))
+
+    def automate_property(self, element, prop, points, mode="linear"):
+        """Drive a property through a list of (seconds_from_now, value) points. The background process
+        applies the curve per buffer, so one call gives a glitch free ramp. mode is linear, cubic or none."""
+        if isinstance(element, ElementProxy):
+            element = element.id
+        a = (element, prop, [list(i) for i in points], mode)
+        r = self.rpc_call("automate_property", args=a, block=0.0001, timeout=10)
+        self._record("automate_property", a, {}, None)
+        return r
+
+    def fade_property(self, element, prop, target, duration, mode="linear"):
+        "Ramp a property from its current value to target over duration seconds, in one call."
+        if isinstance(element, ElementProxy):
+            element = element.id
+        a = (element, prop, target, duration, mode)
+        r = self.rpc_call("fade_property", args=a, block=0.0001, timeout=10)
+        self._record("fade_property", a, {}, None)
+        return r
+
+    def remove_element(self, element, branch=False, send_eos=True, timeout=5):
+        """Remove an element while the pipeline runs.  Whatever fed it gets linked to whatever it fed.
+        With branch=True, everything downstream of it goes too."""
+        if isinstance(element, ElementProxy):
+            element = element.id
+        a = (element, branch, send_eos, timeout)
+        self.rpc_call("remove_element", args=a, block=0.0001, timeout=timeout * 3 + 5)
+        self._record("remove_element", a, {}, None)
+
     def add_pil_capture(self, *a, **k):
         # Probably Just Not Important enough to raise an error for this.
         if self.ended or self.worker.poll() is not None:
             print("Prop set in dead process")
             self.ended = True
             return
-        return ElementProxy(
-            self,
-            self.rpc_call(
-                "addRemotePILCapture", args=a, kwargs=k, block=0.0001, timeout=10
-            ),
+        eid = self.rpc_call(
+            "addRemotePILCapture", args=a, kwargs=k, block=0.0001, timeout=10
+        )
+        self._record("addRemotePILCapture", a, k, eid)
+        e = ElementProxy(self, eid)
+        self._proxies.add(e)
+        return e
+
+    def add_frame_stream(
+        self, fmt="jpeg", max_fps=None, connect_to_output=None, quality=85
+    ) -> int:
+        """Add a branch that encodes frames once and pushes them here as they are made.
+        Must be called before start(). Returns a stream id for iter_frames."""
+        if self.ended or self.worker.poll() is not None:
+            raise RuntimeError("This process is already dead")
+        self._not_replayable("add_frame_stream")
+
+        if isinstance(connect_to_output, ElementProxy):
+            connect_to_output = connect_to_output.id
+
+        stream_id = self.rpc_call(
+            "addRemoteFrameStream",
+            args=(fmt, max_fps, connect_to_output, quality),
+            block=0.0001,
+            timeout=10,
         )
+        with self._frame_lock:
+            self._frame_streams[stream_id] = (fmt, max_fps)
+            self._frame_subscribers[stream_id] = []
+        return stream_id
+
+    def iter_frames(
+        self, fmt="jpeg", max_fps=None, stream=None, queue_size=2, timeout=None
+    ):
+        """Return a generator of encoded frames as bytes, as they are produced.
+
+        Uses an existing stream with the same fmt and max_fps, or creates one, which only works
+        before start(). Each consumer gets its own queue of queue_size frames, and if it falls
+        behind the oldest frames are dropped. The generator ends if no frame arrives within timeout.
+        """
+        if stream is None:
+            with self._frame_lock:
+                for i in self._frame_streams:
+                    if self._frame_streams[i] == (fmt, max_fps):
+                        stream = i
+                        break
+        if stream is None:
+            stream = self.add_frame_stream(fmt, max_fps)
+
+        return self._frame_generator(stream, queue_size, timeout)
+
+    def _frame_generator(self, stream, queue_size, timeout):
+        q = queue.Queue(max(queue_size, 1))
+
+        with self._frame_lock:
+            subscribers = self._frame_subscribers[stream]
+            subscribers.append(q)
+            first = len(subscribers) == 1
+        if first:
+            self.rpc_call(
+                "set_frame_stream_active",
+                args=(stream, True),
+                block=0.0001,
+                timeout=10,
+            )
+
+        try:
+            t = time.monotonic()
+            while not self.ended:
+                try:
+                    frame = q.get(timeout=0.5)
+                except queue.Empty:
+                    if timeout is not None and time.monotonic() - t > timeout:
+                        return
+                    continue
+                t = time.monotonic()
+                yield frame
+        finally:
+            with self._frame_lock:
+                subscribers.remove(q)
+                last = not subscribers
+            if last and not self.ended:
+                try:
+                    self.rpc_call("set_frame_stream_active", args=(stream, False))
+                except Exception:
+                    pass
+
+    def add_audio_tap(
+        self,
+        connect_to_output=None,
+        block_size=1024,
+        channels=2,
+        dtype="float32",
+        max_blocks=8,
+    ) -> AudioTap:
+        """Tap raw audio as arrays of shape (block_size, channels), delivered through shared memory.
+        Without connect_to_output, a tee is inserted in the main chain at this point.
+        Must be called before start()."""
+        if self.ended or self.worker.poll() is not None:
+            raise RuntimeError("This process is already dead")
+
+        self._not_replayable("add_audio_tap")
+
+        if isinstance(connect_to_output, ElementProxy):
+            connect_to_output = connect_to_output.id
+
+        ring = ShmRing.create(block_size * channels * 4, max_blocks)
+        tap = AudioTap(ring, block_size, channels, dtype)
+        try:
+            tap.id = self.rpc_call(
+                "addRemoteAudioTap",
+                args=(ring.name, block_size, channels, connect_to_output),
+                block=0.0001,
+                timeout=10,
+            )
+        except Exception:
+            ring.close()
+            raise
+        self._audio_taps[tap.id] = tap
+        return tap
+
+    def _on_audio_tap_data(self, tap_id, overruns):
+        tap = self._audio_taps.get(tap_id)
+        if tap:
+            tap._on_data(overruns)
+
+    def _close_audio_taps(self):
+        for i in list(self._audio_taps.values()):
+            i.close()
+        self._audio_taps.clear()
+
+    def _on_frame_stream_data(self, stream_id, data):
+        # One decode here serves every subscriber
+        data = base64.b64decode(data)
+        with self._frame_lock:
+            subscribers = list(self._frame_subscribers.get(stream_id, ()))
+
+        for q in subscribers:
+            try:
+                q.put_nowait(data)
+            except queue.Full:
+                # Slow consumer, drop the oldest frame rather than lagging further behind
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    q.put_nowait(data)
+                except queue.Full:
+                    pass
 
     def on_appsink_data(self, element_name, data, *a, **k):
         return
@@ -356,18 +1568,103 @@ class GStreamerPipeline:
     def on_level_message(self, src, rms, level):
         pass
 
+    def enable_metering(self, window=0.25):
+        """Batch level and spectrum messages into one update per window, delivered to on_meter_update
+        and any subscribe_meters callbacks. on_level_message stops being called."""
+        self.rpc_call("set_metering", args=(True, window), block=0.0001, timeout=10)
+
+    def subscribe_meters(self, callback, window=None):
+        "Call callback(update) with each batched meter update.  Metering is enabled if a window is given or it wasn't yet."
+        with self._meter_lock:
+            first = not self._meter_subscribers
+            self._meter_subscribers.append(callback)
+        if first or window:
+            self.enable_metering(window or 0.25)
+
+    def unsubscribe_meters(self, callback):
+        with self._meter_lock:
+            self._meter_subscribers.remove(callback)
+            last = not self._meter_subscribers
+        if last and not self.ended:
+            self.rpc_call("set_metering", args=(False,))
+
+    def _on_meter_update(self, update):
+        self.on_meter_update(update)
+        with self._meter_lock:
+            subscribers = list(self._meter_subscribers)
+        for i in subscribers:
+            try:
+                i(update)
+            except Exception:
+                logging.exception("Error in meter subscriber")
+
+    def get_metrics(self) -> dict:
+        """State, buffers and bytes per second per src pad, queue fill, QoS stats, and RSS and CPU of the
+        background process.  Rates are since the previous call, including pushed ones."""
+        return self.rpc_call("get_metrics", block=0.0001, timeout=10)
+
+    def enable_metrics_push(self, interval: float = 5.0):
+        "Have get_metrics() pushed to on_metrics every interval seconds, 0 to stop"
+        self.rpc_call("set_metrics_push", args=(interval,), block=0.0001, timeout=10)
+
+    def _on_metrics(self, metrics):
+        self.on_metrics(metrics)
+
+    def on_metrics(self, metrics):
+        "Subclass this to get pushed metrics"
+
+    def get_profile(self) -> dict:
+        """With profile set at construction, histograms of per element processing time under
+        "elements" and end to end latency per source->sink path under "paths", in seconds"""
+        return self.rpc_call("get_profile", block=0.0001, timeout=10)
+
+    def write_profile_folded(self, filename: str, metric: str = "total"):
+        """Write per element time in folded stack format, one "pipeline;path;element microseconds"
+        line each, for flamegraph.pl, speedscope and friends"""
+        p = self.get_profile()
+        with open(filename, "w") as f:
+            f.write(fold_profile(p, self._name, metric))
+
+    def on_drift(self, drift, rate):
+        """Subclass this to watch system_time drift correction.  drift is in seconds,
+        positive means ahead of the clock, rate is the playback rate now in use."""
+
+    def on_cue_latency(self, kind, seconds):
+        """Subclass this to see how long prepare() took to preroll (kind is "prepare"),
+        and how long after go() the next buffer reached a sink (kind is "go")."""
+
+    def on_meter_update(self, update):
+        """Subclass this to get batched meter updates, a dict of element name to per channel lists
+        of peak, rms and decay dB, and for spectrum elements a list of band dB per channel."""
+
+    def _wait_worker(self, timeout):
+        "Wait for the worker to exit, returning as soon as it does"
+        try:
+            self.worker.wait(timeout)
+        except TimeoutExpired:
+            pass
+
     def stop(self):
         if self.ended:
             return
 
+        self._close_all_shm_rings()
+        if self.placement:
+            self.placement.release(self)
+
         self.ended = True
+        self._mirror_queue.put(None)
+        if self._standby:
+            self._standby.stop()
+            self._standby = None
         if self.worker.poll() is not None:
             self.ended = True
+            self._close_audio_taps()
             return
         try:
             self.rpc_call("stop", block=0.01, timeout=10)
             self.worker.terminate()
-            time.sleep(0.5)
+            self._wait_worker(0.5)
             self.worker.kill()
             close_fds(self.worker)
             try:
@@ -377,7 +1674,7 @@ class GStreamerPipeline:
 
         except Exception:
             self.worker.terminate()
-            time.sleep(0.5)
+            self._wait_worker(0.5)
             self.worker.kill()
             close_fds(self.worker)
             try:
@@ -386,6 +1683,7 @@ class GStreamerPipeline:
                 pass
             workers.do(self.worker.wait)
 
+        self._close_audio_taps()
         self.rpc = None
 
     def print(self, s):
@@ -399,3 +1697,50 @@ class GStreamerPipeline:
 
 
 GstreamerPipeline = GStreamerPipeline
+
+
+class SyncGroup:
+    """Pipelines in different processes sharing one network clock and one base time,
+    so they play in step without corrective seeks.  The first pipeline added serves the clock,
+    so it has to outlive the rest."""
+
+    def __init__(self, address: str = "127.0.0.1", port: int = 0, margin: float = 0.5):
+        self.address = address
+        self.port = port
+        # Time everyone gets to preroll before the shared start instant
+        self.margin = margin
+        self.leader: Optional[GStreamerPipeline] = None
+        self.members: list[GStreamerPipeline] = []
+        self.base_time: Optional[int] = None
+
+    def add(self, pipeline: GStreamerPipeline):
+        "Add a pipeline.  If the group already started, it joins in at the group's current position"
+        if self.leader is None:
+            self.port = pipeline.serve_clock(self.port, self.address)
+            self.leader = pipeline
+        else:
+            pipeline.join_clock(self.address, self.port)
+        self.members.append(pipeline)
+
+        if self.base_time is not None:
+            pipeline.sync_start(self.base_time)
+
+    def start(self):
+        "Start every member at the same instant, margin seconds from now"
+        if self.leader is None:
+            raise RuntimeError("Empty sync group")
+        self.base_time = self.leader.get_clock_time() + int(self.margin * 10**9)
+
+        # In parallel, each one blocks until it is actually playing
+        threads = [
+            threading.Thread(target=i.sync_start, args=(self.base_time,), daemon=True)
+            for i in self.members
+        ]
+        for i in threads:
+            i.start()
+        for i in threads:
+            i.join()
+
+    def get_offsets(self) -> list[float]:
+        "Each member's get_sync_offset(), these should all be within a millisecond or so"
+        return [i.get_sync_offset() for i in self.members]
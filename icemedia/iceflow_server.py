@@ -3,6 +3,9 @@
 
 from __future__ import annotations
 
+import contextlib
+import fractions
+import json
 import threading
 import time
 import logging
@@ -13,14 +16,30 @@ import os
 import sys
 import base64
 import math
-import gi
+from typing import TYPE_CHECKING
+import select
+import signal
+import socket
+
+# Seconds from this module starting to load to each step of startup, sent to the client when ready.
+# Anything heavy, like PIL, numpy, GstNet or shared memory, is imported when first used instead.
+_t0 = time.perf_counter()
+startup_profile: dict[str, float] = {}
+
+
+def mark_startup(step: str):
+    startup_profile[step] = time.perf_counter() - _t0
+
+
+import gi  # noqa
 
 gi.require_version("Gst", "1.0")
 gi.require_version("GstBase", "1.0")
-gi.require_version("Gtk", "3.0")
 
 
-from gi.repository import Gst  # noqa
+from gi.repository import Gst, GObject  # noqa
+
+mark_startup("import_gi")
 
 
 def doNow(f):
@@ -31,6 +50,7 @@ lock = threading.RLock()
 
 
 Gst.init(None)
+mark_startup("gst_init")
 
 jackChannels = {}
 
@@ -65,6 +85,49 @@ def check_pid(pid: int):
         return True
 
 
+# Sent by the kernel when the client dies. Not SIGTERM, the client uses that for a normal stop,
+# and it also arrives when just the client thread that spawned us exits.
+PDEATHSIG = signal.SIGUSR2
+PR_SET_PDEATHSIG = 1
+
+# Stopping gets this long to release devices before the process kills itself
+SHUTDOWN_TIMEOUT = 3.0
+
+# Self pipe that wakes main(), written by signals and by stop()
+_wake: list[int] = []
+
+
+def set_parent_death_signal(sig: int) -> bool:
+    "Have the kernel send sig when the parent exits.  Linux only, returns False elsewhere"
+    try:
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.prctl(PR_SET_PDEATHSIG, int(sig), 0, 0, 0) == 0
+    except Exception:
+        return False
+
+
+def open_pidfd(pid: int) -> int | None:
+    "A pidfd that polls readable when pid exits, or None before Linux 5.3 / Python 3.9"
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+
+def wake_main():
+    if _wake:
+        try:
+            os.write(_wake[1], b"x")
+        except OSError:
+            pass
+
+
+def parent_alive() -> bool:
+    return os.getppid() == ppid and check_pid(ppid)
+
+
 pipes = weakref.WeakValueDictionary()
 
 log = logging.getLogger("IceFlow_gst")
@@ -74,8 +137,22 @@ log = logging.getLogger("IceFlow_gst")
 # Or we could be running directly with python3 file.py
 try:
     from . import jsonrpyc
+    from . import sched_tools
 except ImportError:
     import jsonrpyc
+    import sched_tools
+
+if TYPE_CHECKING:
+    from .shm_ring import ShmRing
+
+
+def get_shm_ring() -> type[ShmRing]:
+    "Shared memory is only needed for rings to and from the client, and costs a lot to import"
+    try:
+        from .shm_ring import ShmRing
+    except ImportError:
+        from shm_ring import ShmRing
+    return ShmRing
 
 
 class PresenceDetectorRegion:
@@ -172,6 +249,73 @@ class PresenceDetector:
         return r
 
 
+@contextlib.contextmanager
+def map_buffer(buf, flags=Gst.MapFlags.READ):
+    """Map a Gst.Buffer and yield its memory as a memoryview.  With the gst-python overrides
+    this is the mapped memory itself, without copying.  With plain PyGObject, info.data is
+    already a bytes copy.  The view is only valid inside the with block, copy out anything you need to keep."""
+    ok, info = buf.map(flags)
+    if not ok:
+        raise RuntimeError("Could not map buffer")
+    mv = memoryview(info.data)
+    try:
+        yield mv
+    finally:
+        try:
+            mv.release()
+        except BufferError:
+            # Something like an ndarray still references it.  Unmapping would leave it pointing
+            # at memory GStreamer may reuse, so the buffer is left mapped instead.
+            raise BufferError(
+                "Mapped buffer memory is still referenced, copy it out inside the with block"
+            ) from None
+        buf.unmap(info)
+
+
+def rgb_stride(width):
+    "Raw RGB video rows are padded to a multiple of 4 bytes"
+    return (width * 3 + 3) & ~3
+
+
+def rgb_ndarray(data, w, h):
+    "View packed or row padded RGB data as an (h, w, 3) uint8 ndarray, without copying"
+    import numpy as np
+
+    a = np.frombuffer(data, dtype=np.uint8, count=rgb_stride(w) * h)
+    return a.reshape(h, rgb_stride(w))[:, : w * 3].reshape(h, w, 3)
+
+
+class BufferPool:
+    """A fixed ring of reusable bytearrays, for frames that must outlive their Gst.Buffer.
+    Once the slots are big enough, copying a frame in allocates nothing.
+    A slot is reused after `count` more copies, so hold at most count - 1 frames."""
+
+    def __init__(self, count=2):
+        self.slots = [bytearray() for i in range(max(count, 1))]
+        self.index = 0
+        # Number of times a slot had to be (re)allocated, for benchmarking
+        self.allocations = 0
+
+    def copy(self, data) -> memoryview:
+        "Copy data into the next slot and return a view of exactly that many bytes"
+        n = data.nbytes if isinstance(data, memoryview) else len(data)
+        slot = self.slots[self.index]
+        if len(slot) < n:
+            slot = bytearray(n)
+            self.slots[self.index] = slot
+            self.allocations += 1
+        self.index = (self.index + 1) % len(self.slots)
+
+        v = memoryview(slot)[:n]
+        v[:] = data
+        return v
+
+
+def sample_size(sample):
+    s = sample.get_caps().get_structure(0)
+    return s.get_value("width"), s.get_value("height")
+
+
 class PILCapture:
     def __init__(self, appsink):
         from PIL import Image
@@ -186,7 +330,7 @@ class PILCapture:
         x.save(f)
         return 1
 
-    def pull(self, timeout=0.1, force_latest=False):
+    def pull_sample(self, timeout=0.1, force_latest=False):
         sample = self.appsink.emit("try-pull-sample", timeout * 10**9)
 
         if force_latest:
@@ -203,15 +347,50 @@ class PILCapture:
 
             sample = sample2 or sample
 
+        return sample
+
+    def pull(self, timeout=0.1, force_latest=False):
+        sample = self.pull_sample(timeout, force_latest)
         if not sample:
             return None
 
+        w, h = sample_size(sample)
+
+        # Decode straight from the mapped memory, PIL's copy is the only one
+        with map_buffer(sample.get_buffer()) as data:
+            return self.img.frombytes("RGB", (w, h), data, "raw", "RGB", rgb_stride(w))
+
+    @contextlib.contextmanager
+    def pull_mapped(self, timeout=0.1, force_latest=False):
+        """Yield the next frame as an (h, w, 3) ndarray backed directly by the buffer memory, or None.
+        Only meant for use inside the with block, but the buffer stays mapped while any view of it exists."""
+        sample = self.pull_sample(timeout, force_latest)
+        if not sample:
+            yield None
+            return
+
+        w, h = sample_size(sample)
         buf = sample.get_buffer()
-        caps = sample.get_caps()
-        h = caps.get_structure(0).get_value("height")
-        w = caps.get_structure(0).get_value("width")
+        ok, info = buf.map(Gst.MapFlags.READ)
+        if not ok:
+            raise RuntimeError("Could not map buffer")
+        a = rgb_ndarray(info.data, w, h)
+        # Every view of the frame keeps the first array alive, unmap once the last one is gone
+        root = a
+        while isinstance(root.base, type(a)):
+            root = root.base
+        weakref.finalize(root, buf.unmap, info)
+        yield a
+
+    def pull_array(self, pool: BufferPool, timeout=0.1, force_latest=False):
+        "Copy the next frame into the pool and return it as an (h, w, 3) ndarray, or None"
+        sample = self.pull_sample(timeout, force_latest)
+        if not sample:
+            return None
 
-        return self.img.frombytes("RGB", (w, h), buf.extract_dup(0, buf.get_size()))
+        w, h = sample_size(sample)
+        with map_buffer(sample.get_buffer()) as data:
+            return rgb_ndarray(pool.copy(data), w, h)
 
     def pull_raw(self):
         "Pull a tuple consisting of raw RGB bytes, then the height and width with which to decode them."
@@ -219,32 +398,202 @@ class PILCapture:
         if not sample:
             return None
 
-        buf = sample.get_buffer()
-        caps = sample.get_caps()
-        h = caps.get_structure(0).get_value("height")
-        w = caps.get_structure(0).get_value("width")
+        w, h = sample_size(sample)
+        with map_buffer(sample.get_buffer()) as data:
+            return (bytes(data), w, h)
+
+
+def parse_framerate(framerate) -> fractions.Fraction:
+    "Accepts 30, 29.97, '30000/1001' or (30000, 1001)"
+    if isinstance(framerate, (list, tuple)):
+        return fractions.Fraction(int(framerate[0]), int(framerate[1]))
+    return fractions.Fraction(str(framerate))
 
-        return (buf.extract_dup(0, buf.get_size()), w, h)
 
+class AppSource:
+    """Wraps an appsrc with flow control.  push() waits while the appsrc has said enough-data,
+    so a producer that outruns the pipeline blocks instead of growing the queue without bound.
+    If a framerate is given, buffers are stamped with PTS and duration."""
+
+    # A paused or stalled pipeline never asks for more, so never wait forever by default
+    PUSH_TIMEOUT = 5.0
 
-class PILSource:
-    def __init__(self, appsrc, greyscale=False):
+    def __init__(self, appsrc, framerate=None, max_bytes=None):
         self.appsrc = appsrc
+        self.framerate = parse_framerate(framerate) if framerate else None
+
+        # Set by need-data, cleared by enough-data
+        self._can_push = threading.Event()
+        self._can_push.set()
+        self.closed = False
+
+        self.pushed = 0
+        self.dropped = 0
+        self.blocked_time = 0.0
+
+        if self.framerate:
+            self.appsrc.set_property("format", Gst.Format.TIME)
+        if max_bytes:
+            self.appsrc.set_property("max-bytes", int(max_bytes))
+
+        self._on_need_data_wr = wrfunc(weakref.WeakMethod(self._on_need_data))
+        self._on_enough_data_wr = wrfunc(weakref.WeakMethod(self._on_enough_data))
+        self.appsrc.connect("need-data", self._on_need_data_wr, 1)
+        self.appsrc.connect("enough-data", self._on_enough_data_wr, 1)
+
+    def _on_need_data(self, *a):
+        self._can_push.set()
+
+    def _on_enough_data(self, *a):
+        self._can_push.clear()
+
+    def close(self):
+        "Release anyone blocked in push(), further pushes are dropped"
+        self.closed = True
+        self._can_push.set()
+
+    def wait_ready(self, timeout=None) -> bool:
+        "Block until the appsrc wants more data, return False on timeout"
+        if self._can_push.is_set():
+            return True
+        t = time.monotonic()
+        r = self._can_push.wait(timeout)
+        self.blocked_time += time.monotonic() - t
+        return r
+
+    def push(self, b, block=True, timeout=PUSH_TIMEOUT) -> bool:
+        """Push bytes as one buffer.  If the appsrc queue is full, wait up to timeout when block is set,
+        otherwise drop the buffer.  Returns True if it was queued."""
+        if block:
+            ready = self.wait_ready(timeout)
+        else:
+            ready = self._can_push.is_set()
+
+        if self.closed or not ready:
+            self.dropped += 1
+            return False
+
+        buf = Gst.Buffer.new_wrapped(b)
+        if self.framerate:
+            num, den = self.framerate.numerator, self.framerate.denominator
+            buf.pts = Gst.util_uint64_scale(self.pushed, Gst.SECOND * den, num)
+            buf.duration = Gst.util_uint64_scale(Gst.SECOND, den, num)
+        self.pushed += 1
+
+        return self.appsrc.emit("push-buffer", buf) == Gst.FlowReturn.OK
+
+    def stats(self):
+        "Queue depth and flow control counters"
+        s = {
+            "current_level_bytes": self.appsrc.get_property("current-level-bytes"),
+            "max_bytes": self.appsrc.get_property("max-bytes"),
+            "pushed": self.pushed,
+            "dropped": self.dropped,
+            "blocked_time": self.blocked_time,
+            "full": not self._can_push.is_set(),
+        }
+        try:
+            # Only in GStreamer 1.20 and later
+            s["current_level_buffers"] = self.appsrc.get_property(
+                "current-level-buffers"
+            )
+        except TypeError:
+            pass
+        return s
+
+
+class PILSource(AppSource):
+    def __init__(self, appsrc, greyscale=False, framerate=None, max_bytes=None):
+        AppSource.__init__(self, appsrc, framerate, max_bytes)
         self.greyscale = greyscale
 
-    def push(self, img):
-        img = img.tobytes("raw", "L" if self.greyscale else "rgb")
-        img = Gst.Buffer.new_wrapped(img)
-        self.appsrc.emit("push-buffer", img)
+    def push(self, img, block=True, timeout=AppSource.PUSH_TIMEOUT):
+        img = img.tobytes("raw", "L" if self.greyscale else "RGB")
+        return AppSource.push(self, img, block, timeout)
 
 
-class AppSource:
-    def __init__(self, appsrc):
-        self.appsrc = appsrc
+class ShmFeeder:
+    """Moves frames the client wrote into a shared memory ring into an AppSource.
+    The client rings the doorbell after each write, but we also poll in case one was missed.
+    Like AppSource.push, a frame the pipeline doesn't want within PUSH_TIMEOUT is dropped and counted."""
 
-    def push(self, b):
-        b = Gst.Buffer.new_wrapped(b)
-        self.appsrc.emit("push-buffer", b)
+    def __init__(self, source: AppSource, ring: ShmRing):
+        self.source = source
+        self.ring = ring
+        self.doorbell = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(
+            target=self.run, daemon=True, name="nostartstoplog.ShmFeeder"
+        )
+        self.thread.start()
+
+    def run(self):
+        try:
+            while not self.closed:
+                self.doorbell.wait(0.1)
+                self.doorbell.clear()
+                while not self.closed:
+                    v = self.ring.peek()
+                    if v is None:
+                        break
+                    # The only copy. Free the slot before blocking on flow control so the client can keep going.
+                    b = bytes(v)
+                    v.release()
+                    self.ring.advance()
+                    # The frame is already off the ring, so it is pushed even if closing meanwhile
+                    self.source.push(b, timeout=AppSource.PUSH_TIMEOUT)
+        finally:
+            self.ring.close()
+
+    def close(self):
+        self.closed = True
+        self.doorbell.set()
+
+
+class AudioTap:
+    """Cuts F32LE samples from an appsink into fixed size blocks and writes them
+    into a shared memory ring the client reads from.  If the ring is full, new blocks are
+    dropped and counted as overruns.  The client skips to the newest block by default,
+    which is what keeps latency to about one block."""
+
+    def __init__(self, appsink, ring: ShmRing, block_size, channels):
+        self.appsink = appsink
+        self.ring = ring
+        self.block_bytes = block_size * channels * 4
+        self.pending = bytearray()
+        self.overruns = 0
+        self.blocks = 0
+
+        self._on_new_sample_wr = wrfunc(
+            weakref.WeakMethod(self.on_new_sample), fail_return=Gst.FlowReturn.OK
+        )
+        self.appsink.connect("new-sample", self._on_new_sample_wr, 1)
+
+    def on_new_sample(self, appsink, userdata):
+        _ = userdata
+        sample = appsink.emit("pull-sample")
+        if not sample:
+            return Gst.FlowReturn.OK
+
+        with map_buffer(sample.get_buffer()) as data:
+            self.pending += data
+
+        n = 0
+        while len(self.pending) >= self.block_bytes:
+            with memoryview(self.pending) as v:
+                if self.ring.write(v[: self.block_bytes], timeout=0):
+                    n += 1
+                else:
+                    self.overruns += 1
+            del self.pending[: self.block_bytes]
+
+        if n:
+            self.blocks += n
+            call_rpc_if_exists("_on_audio_tap_data", [id(self), self.overruns])
+        return Gst.FlowReturn.OK
+
+    def close(self):
+        self.ring.close()
 
 
 class AppSink:
@@ -253,14 +602,250 @@ class AppSink:
         self.appsink = appsink
 
     def pull(self, timeout=0.1):
+        with self.pull_mapped(timeout) as data:
+            if data is None:
+                return None
+            return bytes(data)
+
+    @contextlib.contextmanager
+    def pull_mapped(self, timeout=0.1):
+        "Yield the next buffer as a memoryview of the mapped memory, or None. Only valid inside the with block."
         sample = self.appsink.emit("try-pull-sample", timeout * 10**9)
         if not sample:
-            return None
+            yield None
+            return
+
+        with map_buffer(sample.get_buffer()) as data:
+            yield data
 
+    def pull_into(self, pool: BufferPool, timeout=0.1):
+        "Copy the next buffer into the pool and return a memoryview of it, or None"
+        with self.pull_mapped(timeout) as data:
+            if data is None:
+                return None
+            return pool.copy(data)
+
+
+class PreTriggerRecorder:
+    """Keeps the last pre_roll seconds of encoded video in memory, always starting on a keyframe.
+    trigger() writes that and everything after it to a file, through a separate appsrc, muxer and
+    filesink pipeline, so the main pipeline never restarts.  release() stops post_roll seconds later."""
+
+    def __init__(self, appsink, pre_roll, post_roll, max_bytes, mux):
+        self.appsink = appsink
+        self.pre_roll = int(pre_roll * Gst.SECOND)
+        self.post_roll = int(post_roll * Gst.SECOND)
+        self.max_bytes = max_bytes
+        self.mux = mux
+        self.lock = threading.Lock()
+
+        # (buffer, is_keyframe), the first is always a keyframe
+        self.ring: list[tuple[Gst.Buffer, bool]] = []
+        self.ring_bytes = 0
+        self.caps: Gst.Caps | None = None
+
+        # The pipeline currently writing a file
+        self.writer: Gst.Pipeline | None = None
+        self.appsrc = None
+        self.filename = None
+        self.offset = None
+        # Stream time to stop writing at, set by release()
+        self.stop_at = None
+
+        self.stats = {"recordings": 0, "dropped_gops": 0, "bytes_written": 0}
+
+        self._on_new_sample_wr = wrfunc(
+            weakref.WeakMethod(self.on_new_sample), fail_return=Gst.FlowReturn.OK
+        )
+        self.appsink.connect("new-sample", self._on_new_sample_wr, 1)
+
+    @staticmethod
+    def _time(buf):
+        "DTS if there is one, it's what always increases"
+        return buf.dts if buf.dts != Gst.CLOCK_TIME_NONE else buf.pts
+
+    def _drop_gop(self):
+        "Drop up to the next keyframe, keeping the ring starting on one"
+        buf, _ = self.ring.pop(0)
+        self.ring_bytes -= buf.get_size()
+        while self.ring and not self.ring[0][1]:
+            buf, _ = self.ring.pop(0)
+            self.ring_bytes -= buf.get_size()
+        self.stats["dropped_gops"] += 1
+
+    def on_new_sample(self, appsink, userdata):
+        _ = userdata
+        sample = appsink.emit("pull-sample")
+        if not sample:
+            return Gst.FlowReturn.OK
         buf = sample.get_buffer()
-        sample.get_caps()
+        key = not buf.has_flags(Gst.BufferFlags.DELTA_UNIT)
+
+        with self.lock:
+            self.caps = sample.get_caps()
+            if self.writer:
+                self._write(buf)
+                if self.stop_at is not None and self._time(buf) >= self.stop_at:
+                    self._finish()
+                return Gst.FlowReturn.OK
+
+            # Can't start a file mid GOP
+            if not self.ring and not key:
+                return Gst.FlowReturn.OK
+            self.ring.append((buf, key))
+            self.ring_bytes += buf.get_size()
+
+            # Only whole GOPs are dropped, so this keeps a bit more than pre_roll
+            now = self._time(buf)
+            while True:
+                keys = [i for i, (b, k) in enumerate(self.ring) if k and i]
+                if not keys:
+                    break
+                if now - self._time(self.ring[keys[0]][0]) >= self.pre_roll:
+                    self._drop_gop()
+                elif self.ring_bytes > self.max_bytes:
+                    self._drop_gop()
+                else:
+                    break
+            # One GOP bigger than the limit, wait for the next keyframe
+            if self.ring_bytes > self.max_bytes:
+                self.ring.clear()
+                self.ring_bytes = 0
+                self.stats["dropped_gops"] += 1
+
+        return Gst.FlowReturn.OK
+
+    def _write(self, buf):
+        # The file has to start on a keyframe, which sets time zero
+        if self.offset is None:
+            if buf.has_flags(Gst.BufferFlags.DELTA_UNIT):
+                return
+            self.offset = self._time(buf)
+
+        # A new Gst.Buffer for the new timestamps, the ring's aren't writable
+        b = buf.copy()
+        if b.pts != Gst.CLOCK_TIME_NONE:
+            b.pts = max(b.pts - self.offset, 0)
+        if b.dts != Gst.CLOCK_TIME_NONE:
+            b.dts = max(b.dts - self.offset, 0)
+        self.stats["bytes_written"] += b.get_size()
+        self.appsrc.emit("push-buffer", b)
+
+    def trigger(self, filename):
+        """Start writing to filename with the pre-roll, or if already writing,
+        cancel any pending release and keep going."""
+        with self.lock:
+            if self.writer:
+                self.stop_at = None
+                return self.filename
+            if not self.caps:
+                raise RuntimeError("No video has reached the recorder yet")
+
+            # Built in locals, so a failure here leaves the recorder buffering, not half writing
+            mux = registry.make(self.mux)
+            if mux is None:
+                raise ValueError("Nonexistant element type: " + self.mux)
+            writer = Gst.Pipeline()
+            appsrc = Gst.ElementFactory.make("appsrc")
+            appsrc.set_property("caps", self.caps)
+            appsrc.set_property("format", Gst.Format.TIME)
+            # Never block the streaming thread of the main pipeline
+            appsrc.set_property("max-bytes", 0)
+            appsrc.set_property("block", False)
+            sink = Gst.ElementFactory.make("filesink")
+            sink.set_property("location", filename)
+            sink.set_property("async", False)
+            for i in (appsrc, mux, sink):
+                writer.add(i)
+            link(appsrc, mux)
+            link(mux, sink)
+            if writer.set_state(Gst.State.PLAYING) == Gst.StateChangeReturn.FAILURE:
+                writer.set_state(Gst.State.NULL)
+                raise RuntimeError("Could not start writing to " + filename)
+
+            self.writer = writer
+            self.appsrc = appsrc
+            self.filename = filename
+            self.stop_at = None
+            self.stats["recordings"] += 1
+            self.offset = None
+            for buf, _ in self.ring:
+                self._write(buf)
+            self.ring.clear()
+            self.ring_bytes = 0
+            return filename
+
+    def release(self):
+        "Stop post_roll seconds of stream time after the latest buffer"
+        with self.lock:
+            if not self.writer:
+                return
+            sample = self.appsink.get_property("last-sample")
+            if not sample:
+                return self._finish()
+            self.stop_at = self._time(sample.get_buffer()) + self.post_roll
+
+    def _finish(self):
+        "Called with the lock held, closes the file without blocking the streaming thread"
+        writer, appsrc, filename = self.writer, self.appsrc, self.filename
+        self.writer = self.appsrc = None
+        self.stop_at = None
+        appsrc.emit("end-of-stream")
+
+        def f():
+            # The muxer has to see EOS to write its index
+            writer.get_bus().timed_pop_filtered(
+                10 * Gst.SECOND, Gst.MessageType.EOS | Gst.MessageType.ERROR
+            )
+            writer.set_state(Gst.State.NULL)
+            call_rpc_if_exists("_on_recording_done", [id(self), filename])
+
+        threading.Thread(target=f, daemon=True, name="IceflowRecorderFinish").start()
+
+    def close(self):
+        with self.lock:
+            if self.writer:
+                self._finish()
+            self.ring.clear()
+            self.ring_bytes = 0
+
+
+# Maps the fmt argument of add_frame_stream to an encoder element and the caps the appsink gets
+frame_stream_formats = {
+    "jpeg": ("jpegenc", "image/jpeg"),
+    "png": ("pngenc", "image/png"),
+    "rgb": (None, "video/x-raw,format=RGB"),
+}
 
-        return buf.extract_dup(0, buf.get_size())
+
+class FrameStream:
+    """Encodes each frame once and pushes it to the client as soon as it is produced.
+    The client fans the frames out to however many subscribers it has."""
+
+    def __init__(self, appsink, fmt):
+        self.appsink = appsink
+        self.fmt = fmt
+        # Nothing gets sent over RPC unless the client has at least one subscriber
+        self.active = False
+
+        self._on_new_sample_wr = wrfunc(
+            weakref.WeakMethod(self.on_new_sample), fail_return=Gst.FlowReturn.OK
+        )
+        self.appsink.connect("new-sample", self._on_new_sample_wr, 1)
+
+    def on_new_sample(self, appsink, userdata):
+        _ = userdata
+        sample = appsink.emit("pull-sample")
+        if not sample:
+            return Gst.FlowReturn.OK
+
+        if not self.active:
+            return Gst.FlowReturn.OK
+
+        with map_buffer(sample.get_buffer()) as data:
+            data = base64.b64encode(data).decode()
+        call_rpc_if_exists("_on_frame_stream_data", [id(self), data])
+        return Gst.FlowReturn.OK
 
 
 def link(a, b):
@@ -292,14 +877,209 @@ def link(a, b):
             pass  # b.unref()
 
 
+def release_if_requested(pad):
+    "Give back a pad that came from a request template, like a tee src_%u"
+    t = pad.get_pad_template()
+    if t and t.presence == Gst.PadPresence.REQUEST:
+        pad.get_parent_element().release_request_pad(pad)
+
+
+def stream_paths(name: str) -> tuple[str, str]:
+    """Socket and caps sidecar file for a published stream.
+    Shared by every iceflow process of this user, ICEFLOW_STREAM_DIR overrides the place."""
+    if not name.replace("-", "").replace("_", "").isalnum():
+        raise ValueError(
+            "Stream names can only have letters, numbers, - and _: " + name
+        )
+    d = os.environ.get("ICEFLOW_STREAM_DIR") or os.path.join(
+        os.environ.get("XDG_RUNTIME_DIR") or "/tmp", "iceflow_streams"
+    )
+    os.makedirs(d, mode=0o700, exist_ok=True)
+    base = os.path.join(d, name)
+    return base + ".sock", base + ".caps"
+
+
+def socket_listening(path: str) -> bool:
+    "True if a publisher is actually there, not just a socket file left by a crash"
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+            return True
+        except OSError:
+            return False
+
+
+def read_stream_caps(name: str) -> str | None:
+    sock_path, caps_path = stream_paths(name)
+    if not socket_listening(sock_path):
+        return None
+    try:
+        with open(caps_path) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
 elementsByShortId = weakref.WeakValueDictionary()
 
+INT_TYPES = {
+    GObject.TYPE_INT,
+    GObject.TYPE_UINT,
+    GObject.TYPE_LONG,
+    GObject.TYPE_ULONG,
+    GObject.TYPE_INT64,
+    GObject.TYPE_UINT64,
+    GObject.TYPE_CHAR,
+    GObject.TYPE_UCHAR,
+}
+FLOAT_TYPES = {GObject.TYPE_FLOAT, GObject.TYPE_DOUBLE}
+
+
+def jsonable(v):
+    "Property defaults as something JSON can carry"
+    if v is None or isinstance(v, (bool, int, float, str)):
+        return v
+    if isinstance(v, (GObject.GEnum, GObject.GFlags)):
+        return int(v)
+    return str(v)
+
+
+ALREADY_SET = object()
+
+
+class ElementRegistry:
+    """Per process cache of element factories, parsed caps, and property specs.
+    The plugin registry doesn't change while a process runs, so nothing here is ever invalidated."""
+
+    # Caps strings are usually a handful reused over and over, this just stops a leak
+    # if something generates unique ones.
+    MAX_CAPS = 1024
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.factories: dict[str, Gst.ElementFactory | None] = {}
+        self.parsed_caps: dict[str, Gst.Caps] = {}
+        # GType name -> property name -> GParamSpec
+        self.pspecs: dict[str, dict[str, GObject.ParamSpec | None]] = {}
+        self.descriptions: dict[str, dict] = {}
+        self.names: list[str] | None = None
+
+    def factory(self, name: str) -> Gst.ElementFactory | None:
+        try:
+            return self.factories[name]
+        except KeyError:
+            f = Gst.ElementFactory.find(name)
+            with self.lock:
+                self.factories[name] = f
+            return f
+
+    def make(self, name: str, element_name: str | None = None) -> Gst.Element | None:
+        f = self.factory(name)
+        return f.create(element_name) if f else None
+
+    def caps(self, s: str) -> Gst.Caps:
+        try:
+            return self.parsed_caps[s]
+        except KeyError:
+            # Shared caps are never writable, so every user getting the same object is fine
+            c = Gst.Caps.from_string(s)
+            if c is None:
+                raise ValueError("Could not parse caps: " + s)
+            with self.lock:
+                if len(self.parsed_caps) >= self.MAX_CAPS:
+                    self.parsed_caps.clear()
+                self.parsed_caps[s] = c
+            return c
+
+    def pspec(self, element: GObject.Object, prop: str) -> GObject.ParamSpec | None:
+        props = self.pspecs.setdefault(type(element).__gtype__.name, {})
+        try:
+            return props[prop]
+        except KeyError:
+            p = element.find_property(prop)
+            with self.lock:
+                props[prop] = p
+            return p
+
+    def coerce(self, element: GObject.Object, prop: str, value):
+        """Fix up values that came through JSON, like 5.0 for an int or 1 for a boolean.
+        Returns the value to set, or ALREADY_SET if it was a string that GStreamer's own
+        parser has set, which handles enum nicks, flags and fractions."""
+        p = self.pspec(element, prop)
+        if p is None:
+            raise ValueError(f"{element.get_name()} has no property {prop}")
+        t = p.value_type.fundamental
+
+        if isinstance(value, str) and t != GObject.TYPE_STRING:
+            if p.value_type == Gst.Caps.__gtype__:
+                return self.caps(value)
+            Gst.util_set_object_arg(element, prop, value)
+            return ALREADY_SET
+        if t in INT_TYPES and isinstance(value, float) and value.is_integer():
+            return int(value)
+        if t in FLOAT_TYPES and isinstance(value, int) and not isinstance(value, bool):
+            return float(value)
+        if t == GObject.TYPE_BOOLEAN and isinstance(value, (int, float)):
+            return bool(value)
+        return value
+
+    def list_elements(self) -> list[str]:
+        if self.names is None:
+            features = Gst.Registry.get().get_feature_list(Gst.ElementFactory)
+            self.names = sorted(i.get_name() for i in features)
+        return self.names
+
+    def describe(self, name: str) -> dict:
+        "Class, pad templates and properties of an element type, all JSON-able"
+        if name in self.descriptions:
+            return self.descriptions[name]
+
+        f = self.factory(name)
+        if f is None:
+            raise ValueError("Nonexistant element type: " + name)
+
+        pads = []
+        for t in f.get_static_pad_templates():
+            pads.append(
+                {
+                    "name": t.name_template,
+                    "direction": t.direction.value_nick,
+                    "presence": t.presence.value_nick,
+                    "caps": t.get_caps().to_string(),
+                }
+            )
+
+        props = {}
+        e = f.create(None)
+        for p in e.list_properties() if e else []:
+            props[p.name] = {
+                "type": p.value_type.name,
+                "default": jsonable(p.get_default_value()),
+                "writable": bool(p.flags & GObject.ParamFlags.WRITABLE),
+                "blurb": p.get_blurb(),
+            }
+
+        d = {
+            "name": name,
+            "klass": f.get_metadata("klass"),
+            "description": f.get_metadata("description"),
+            "rank": f.get_rank(),
+            "pads": pads,
+            "properties": props,
+        }
+        with self.lock:
+            self.descriptions[name] = d
+        return d
+
+
+registry = ElementRegistry()
+
 
 def Element(n, name=None):
     _ = name
-    e = Gst.ElementFactory.make(n, None)
-    elementsByShortId[id(e)] = e
+    e = registry.make(n)
     if e:
+        elementsByShortId[id(e)] = e
         return e
     else:
         raise ValueError("No such element exists: " + n)
@@ -313,10 +1093,7 @@ mainContext = None
 
 
 def does_element_exist(n):
-    n = Gst.ElementFactory.make(n)
-    if n:
-        pass  # n.unref()
-    return True
+    return registry.factory(n) is not None
 
 
 def wrfunc(f, fail_return=None):
@@ -339,7 +1116,7 @@ def makeWeakrefPoller(selfref, exitSignal):
 
             self.thread_started = True
             if not self.shouldRunThread:
-                exitSignal.append(True)
+                exitSignal.set()
 
                 # We can't allow returns to happen till the pipeline is null.  That could cause a segfault
                 # on garbage collection.  So we choose a memory leak instead.
@@ -355,25 +1132,26 @@ def makeWeakrefPoller(selfref, exitSignal):
                 if t < time.monotonic() - 3:
                     t = time.monotonic()
                     try:
-                        # If we can't get the lock, don't block the message thread
-                        if self.lock.acquire(timeout=1):
+                        # If we can't get the lock, don't block the message thread,
+                        # whoever has it may be waiting on us for a state change.
+                        if self.lock.acquire(blocking=False):
                             try:
                                 self.loopCallback()
                             finally:
                                 self.lock.release()
 
-                        state = self.pipeline.get_state(1000000000)[1]
+                        state = self.pipeline.get_state(0)[1]
                         if not state == Gst.State.NULL:
                             self.wasEverRunning = True
 
                         # Set the flag if anything ever drives us into the null state
                         if self.wasEverRunning and state == Gst.State.NULL:
                             self.shouldRunThread = False
-                            exitSignal.append(True)
+                            exitSignal.set()
                             return
                     except Exception:
                         # Todo actually handle some errors?
-                        exitSignal.append(True)
+                        exitSignal.set()
                         # After pipeline deleted, we clean up
                         if hasattr(self, "pipeline") and hasattr(self, "bus"):
                             try:
@@ -402,21 +1180,40 @@ def makeWeakrefPoller(selfref, exitSignal):
                         if msg.seqnum != seq_num:
                             self._on_segment_done()
 
+                    elif msg.type == Gst.MessageType.QOS:
+                        self._on_qos(msg)
+
                     self._on_message(self.bus, msg, None)
 
                     seq_num = msg.seqnum
                 except Exception:
                     sys.stderr.write(traceback.format_exc())
                 finally:
-                    pass
-            else:
+                    # Anything waiting in _waitForState rechecks on every message,
+                    # STATE_CHANGED and ASYNC_DONE being the ones that usually matter.
+                    with self.stateCondition:
+                        self.stateCondition.notify_all()
+            elif not (self.stateWaiters or self.stateChanges):
                 # Too quiet in here and the seeklock is taken, assume the seek was jammed
-                # by a move to the pause state
+                # by a move to the pause state.  Not if someone is just waiting on a slow
+                # state change or going through start, pause or prepare, they hold the lock too.
                 if self.seeklock.acquire(timeout=0.25):
                     self.seeklock.release()
                 else:
                     self.pipeline.set_state(Gst.State.PLAYING)
 
+            # Level messages may have stopped, don't sit on a partial window forever
+            self._flush_meter()
+
+            if self.driftController:
+                self._correctDrift()
+
+            if self.metricsInterval:
+                self._pushMetrics()
+
+            if self.watchdogTimeout:
+                self._checkStall()
+
             del self
 
             # time.sleep(1)
@@ -424,6 +1221,440 @@ def makeWeakrefPoller(selfref, exitSignal):
     return pollerf
 
 
+# Anything quieter than this is reported as this, JSON has no -inf
+METER_FLOOR_DB = -150.0
+
+
+def db_to_power(db):
+    return 10 ** (db / 10)
+
+
+def power_to_db(p):
+    if p <= 0:
+        return METER_FLOOR_DB
+    return max(10 * math.log10(p), METER_FLOOR_DB)
+
+
+def mean_db(values):
+    "Average dB values the right way, as power, not as numbers"
+    if not values:
+        return METER_FLOOR_DB
+    return power_to_db(sum(db_to_power(i) for i in values) / len(values))
+
+
+class Meter:
+    """Collects level and spectrum messages per element over a window, keeping each channel
+    separate. Peak is the max over the window, RMS and spectrum bands are power averages."""
+
+    def __init__(self, window=0.25):
+        self.window = window
+        self.window_start = time.monotonic()
+        self.sources = {}
+
+    def _source(self, name):
+        if name not in self.sources:
+            self.sources[name] = {"count": 0}
+        return self.sources[name]
+
+    @staticmethod
+    def _accumulate_power(d, key, values):
+        p = d.get(key)
+        if p is None or len(p) != len(values):
+            d[key] = [db_to_power(i) for i in values]
+        else:
+            for i, v in enumerate(values):
+                p[i] += db_to_power(v)
+
+    def add_level(self, name, s):
+        d = self._source(name)
+        d["count"] += 1
+
+        peak = list(s["peak"])
+        if "peak" in d and len(d["peak"]) == len(peak):
+            d["peak"] = [max(a, b) for a, b in zip(d["peak"], peak)]
+        else:
+            d["peak"] = peak
+
+        self._accumulate_power(d, "rms", list(s["rms"]))
+        d["decay"] = list(s["decay"])
+
+    def add_spectrum(self, name, s):
+        d = self._source(name)
+        d["spectrum_count"] = d.get("spectrum_count", 0) + 1
+
+        m = list(s["magnitude"])
+        # With multi-channel=true this is already a list of bands per channel
+        if not (m and isinstance(m[0], (list, tuple))):
+            m = [m]
+        m = [list(i) for i in m]
+        spectrum = d.get("spectrum")
+        if spectrum is None or len(spectrum) != len(m):
+            d["spectrum"] = spectrum = [{} for i in m]
+        for channel, bands in zip(spectrum, m):
+            self._accumulate_power(channel, "bands", bands)
+
+    def due(self):
+        return time.monotonic() - self.window_start >= self.window
+
+    def flush(self):
+        "Return the aggregated window as a dict of element name to per channel lists, and start a new one"
+        r = {}
+        for name, d in self.sources.items():
+            o = {}
+            if d["count"]:
+                o["peak"] = [round(max(i, METER_FLOOR_DB), 2) for i in d["peak"]]
+                o["rms"] = [round(power_to_db(i / d["count"]), 2) for i in d["rms"]]
+                o["decay"] = [round(max(i, METER_FLOOR_DB), 2) for i in d["decay"]]
+            if d.get("spectrum_count"):
+                o["spectrum"] = [
+                    [round(power_to_db(i / d["spectrum_count"]), 2) for i in c["bands"]]
+                    for c in d["spectrum"]
+                ]
+            if o:
+                r[name] = o
+
+        self.sources = {}
+        self.window_start = time.monotonic()
+        return r
+
+
+class Histogram:
+    "Log spaced latency histogram, 1-2-5 buckets from 1us to 10s"
+
+    BOUNDS = [m * 10**e / 10**6 for e in range(7) for m in (1, 2, 5)] + [10.0]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, v):
+        i = 0
+        while i < len(self.BOUNDS) and v > self.BOUNDS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += v
+        self.max = max(self.max, v)
+
+    def percentile(self, p):
+        "Upper bound of the bucket the pth percentile falls in"
+        target = self.count * p / 100
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if c and n >= target:
+                return self.BOUNDS[i] if i < len(self.BOUNDS) else self.max
+        return None
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else None,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            # Upper bound of each bucket, None for the overflow one
+            "buckets": [
+                [self.BOUNDS[i] if i < len(self.BOUNDS) else None, c]
+                for i, c in enumerate(self.counts)
+                if c
+            ],
+        }
+
+
+def parse_tracer_time(v):
+    "Tracers report times as guint64 nanoseconds, or as H:MM:SS.nnnnnnnnn strings"
+    if isinstance(v, str):
+        h, m, sec = v.split(":")
+        return int(h) * 3600 + int(m) * 60 + float(sec)
+    return v / 10**9
+
+
+class TracerProfiler:
+    """Collects latency and proctime tracer records from the GStreamer debug log.
+    The tracers themselves are set up by GST_TRACERS in the environment before Gst.init()"""
+
+    def __init__(self):
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.reset()
+        # Log functions are process wide and can't take a weakref, so this one is never removed
+        Gst.debug_add_log_function(self._log, None)
+        # Otherwise the default handler formats and writes every record as well, to /dev/null
+        Gst.debug_remove_log_function(None)
+
+    def reset(self):
+        with self.lock:
+            self.elements = {}
+            self.paths = {}
+
+    def _log(self, category, level, file, function, line, obj, message, *user_data):
+        if not self.enabled or category.get_name() != "GST_TRACER":
+            return
+        st, _ = Gst.Structure.from_string(message.get())
+        if st:
+            self.add_record(st)
+
+    def add_record(self, st):
+        name = st.get_name()
+        if not st.has_field("time"):
+            return
+        t = parse_tracer_time(st.get_value("time"))
+
+        if name == "latency":
+            key = st.get_value("src-element") + "->" + st.get_value("sink-element")
+            table = self.paths
+        elif name in ("element-latency", "proctime"):
+            key = st.get_value("element")
+            table = self.elements
+        else:
+            return
+
+        with self.lock:
+            if key not in table:
+                table[key] = Histogram()
+            table[key].add(t)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "elements": {k: v.to_dict() for k, v in self.elements.items()},
+                "paths": {k: v.to_dict() for k, v in self.paths.items()},
+            }
+
+
+class FlowWatch:
+    "Time of the last buffer to reach any sink, kept by probes on the sink pads"
+
+    def __init__(self):
+        self.last = time.monotonic()
+        self.watched = set()
+
+    def probe(self, pad, info):
+        self.last = time.monotonic()
+        return Gst.PadProbeReturn.OK
+
+    def watch(self, pipeline):
+        for sink in pipeline.iterate_sinks():
+            for pad in sink.sinkpads:
+                key = sink.get_name() + ":" + pad.get_name()
+                if key not in self.watched:
+                    self.watched.add(key)
+                    pad.add_probe(
+                        Gst.PadProbeType.BUFFER | Gst.PadProbeType.BUFFER_LIST,
+                        self.probe,
+                    )
+
+
+class PadCounter:
+    "Buffers and bytes through a pad, counted by a probe"
+
+    def __init__(self):
+        self.buffers = 0
+        self.bytes = 0
+        self.last = (0, 0, time.monotonic())
+
+    def probe(self, pad, info):
+        if info.type & Gst.PadProbeType.BUFFER_LIST:
+            buffers = info.get_buffer_list()
+            self.buffers += buffers.length()
+            self.bytes += buffers.calculate_size()
+        else:
+            self.buffers += 1
+            self.bytes += info.get_buffer().get_size()
+        return Gst.PadProbeReturn.OK
+
+    def rates(self):
+        "Totals, and per second rates since the last call"
+        now = time.monotonic()
+        buffers, nbytes, t = self.last
+        dt = max(now - t, 0.000001)
+        self.last = (self.buffers, self.bytes, now)
+        return {
+            "buffers": self.buffers,
+            "bytes": self.bytes,
+            "buffers_per_s": (self.buffers - buffers) / dt,
+            "bytes_per_s": (self.bytes - nbytes) / dt,
+        }
+
+
+def queue_fill(e):
+    "Current and max levels of a queue, and fill as the fraction of whichever limit is closest"
+    r = {}
+    fill = 0.0
+    for unit in ("buffers", "bytes", "time"):
+        current = e.get_property("current-level-" + unit)
+        limit = e.get_property("max-size-" + unit)
+        r[unit] = current
+        r["max_" + unit] = limit
+        if limit:
+            fill = max(fill, current / limit)
+    r["fill"] = fill
+    return r
+
+
+class ProcessStats:
+    "RSS and CPU use of this process"
+
+    def __init__(self):
+        self.last = (self.cpu_time(), time.monotonic())
+
+    @staticmethod
+    def cpu_time():
+        t = os.times()
+        return t.user + t.system
+
+    @staticmethod
+    def rss():
+        "Resident set size in bytes"
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def sample(self):
+        "CPU usage in cores is since the last call"
+        cpu = self.cpu_time()
+        now = time.monotonic()
+        usage = (cpu - self.last[0]) / max(now - self.last[1], 0.000001)
+        self.last = (cpu, now)
+        return {"rss": self.rss(), "cpu_time": cpu, "cpu_usage": usage}
+
+
+class DriftController:
+    """Turns measured drift, position minus where the reference clock says we should be,
+    into a playback rate.  Inside the deadband the rate goes back to nominal,
+    past max_drift a rate change would take too long so a seek is asked for instead."""
+
+    def __init__(self, gain=0.1, deadband=0.005, max_adjust=0.005, max_drift=0.5):
+        self.gain = gain
+        self.deadband = deadband
+        self.max_adjust = max_adjust
+        self.max_drift = max_drift
+
+    def update(self, drift, nominal=1.0):
+        "Returns (action, rate), action being 'ok', 'rate' or 'seek'"
+        if abs(drift) > self.max_drift:
+            return "seek", nominal
+        if abs(drift) < self.deadband:
+            return "ok", nominal
+        adjust = max(-self.max_adjust, min(self.max_adjust, -self.gain * drift))
+        return "rate", nominal * (1 + adjust)
+
+
+class LatencyStats:
+    "Running count, mean, max and last of a latency in seconds"
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = None
+        # For things like coalesced seeks that never happened
+        self.dropped = 0
+
+    def add(self, v):
+        self.count += 1
+        self.total += v
+        self.max = max(self.max, v)
+        self.last = v
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "max": self.max,
+            "last": self.last,
+            "dropped": self.dropped,
+        }
+
+
+def makeWeakrefScrubber(selfref):
+    "Runs pending scrub seeks one at a time, without keeping the pipeline alive"
+
+    def scrubber():
+        while True:
+            self = selfref()
+            if self is None or self.exiting:
+                return
+            ev = self._scrubEvent
+            del self
+
+            if not ev.wait(1):
+                continue
+
+            self = selfref()
+            if self is None:
+                return
+            try:
+                self._doPendingScrub()
+            except Exception:
+                log.exception("Error in scrub seek")
+            del self
+
+    return scrubber
+
+
+def get_gst_controller():
+    "GstController is only needed for automation, so don't load it unless asked"
+    gi.require_version("GstController", "1.0")
+    from gi.repository import GstController
+
+    return GstController
+
+
+# Element klass keywords to streaming thread roles, first match wins
+THREAD_ROLES = [
+    (("Sink", "Audio"), "audio_sink"),
+    (("Sink", "Video"), "video_sink"),
+    (("Sink",), "sink"),
+    (("Decoder",), "decoder"),
+    (("Demuxer",), "decoder"),
+    (("Encoder",), "encoder"),
+    (("Analyzer",), "analysis"),
+    (("Source",), "source"),
+]
+
+
+def element_role(e):
+    f = e.get_factory()
+    klass = f.get_metadata("klass") if f else ""
+    for words, role in THREAD_ROLES:
+        if all(w in klass for w in words):
+            return role
+    return None
+
+
+def thread_role(owner, max_hops=8):
+    """The role of a streaming thread, from the element that owns it.  Queues and other
+    generic elements take the role of the first thing downstream that has one."""
+    e = owner
+    for i in range(max_hops):
+        if not e:
+            break
+        role = element_role(e)
+        if role:
+            return role
+        peers = [p.get_peer() for p in e.srcpads if p.get_peer()]
+        e = peers[0].get_parent_element() if peers else None
+    return "other"
+
+
+def get_gst_net():
+    "GstNet is only needed for sync groups"
+    gi.require_version("GstNet", "1.0")
+    from gi.repository import GstNet
+
+    return GstNet
+
+
 def getCaps(e):
     try:
         return e.caps
@@ -456,12 +1687,79 @@ def linkClosureMaker(
 class GStreamerPipeline:
     """Semi-immutable pipeline that presents a nice subclassable GST pipeline You can only add stuff to it."""
 
-    def __init__(self, name=None, realtime=None, system_time=False):
+    def __init__(self, name=None, realtime=None, system_time=False, profile=False):
         self.lock = threading.RLock()
 
         self.seeklock = self.lock
 
         self.pilcaptures = []
+        self.frame_streams = []
+        self.appsources = []
+        self.shm_feeders = {}
+        # Plain appsrc -> the AppSource wrapped around it for shm feeding, reused by every new ring
+        self.shm_appsources = {}
+        self.audio_taps = []
+        self.recorders = []
+        # Stream name -> shmsink, and shmsrc -> (stream name, capsfilter)
+        self.publishedStreams = {}
+        self.subscribedStreams = {}
+        # Subscribed shmsrcs with a _resubscribe already waiting on their publisher
+        self.resubscribing = set()
+        # compositor -> {"size": (w, h), "pads": [sink pads in input order]}
+        self.compositors = {}
+
+        # Set by set_metering
+        self.meter = None
+
+        # (id(element), prop) -> (binding, control source) for automate_property
+        self.control_bindings = {}
+
+        self.seek_stats = {"seek": LatencyStats(), "scrub": LatencyStats()}
+
+        # prepare() parks the pipeline prerolled at a cue point, go() starts it
+        self.prepared = False
+        self.cuePosition = 0
+        self.cue_stats = {"prepare": LatencyStats(), "go": LatencyStats()}
+        self._firstBufferProbes = []
+
+        # Sync groups share one network clock and one base time across processes
+        self.clockProvider = None
+        self.groupClock = None
+        self.syncBaseTime = None
+
+        # Only system_time pipelines have a reference to drift from
+        self.driftController = DriftController() if system_time else None
+        self.driftInterval = 1.0
+        self.lastDriftCheck = 0
+        self.drift_stats = {"drift": None, "rate": 1.0, "rate_changes": 0, "seeks": 0}
+
+        # "element:pad" -> PadCounter.  Probes only go in once someone asks for metrics
+        self.padCounters = {}
+        # Element name -> QoS totals
+        self.qosStats = {}
+        self.processStats = ProcessStats()
+        self.metricsInterval = 0
+        self.lastMetricsPush = 0
+
+        # Tracer records only exist if the client started us with GST_TRACERS set
+        self.profiler = TracerProfiler() if profile else None
+
+        # Stall watchdog, see set_watchdog()
+        self.flowWatch = FlowWatch()
+        self.watchdogTimeout = 0
+        self.watchdogRestart = True
+        self.watchdogMaxRestarts = 3
+        self.watchdogRestarts = 0
+        self._recovering = False
+        self._recoveryStarted = 0
+        self._gaveUp = False
+
+        # Scrubbing keeps only the newest target, a background thread does the actual seeks
+        self._scrubLock = threading.Lock()
+        self._scrubEvent = threading.Event()
+        self._scrubTarget = None
+        self._scrubThread = None
+        self._lastScrubPosition = None
 
         self.appsink = None
         # We use this for detecting motion.
@@ -485,8 +1783,14 @@ class GStreamerPipeline:
         # This WeakValueDictionary is mostly for testing purposes
         pipes[id(self)] = self
 
-        # Thread puts something in this so we know we exited
-        self.exitSignal = []
+        # Thread sets this so we know we exited
+        self.exitSignal = threading.Event()
+
+        # The poller notifies this on every bus message, state waits sleep on it
+        self.stateCondition = threading.Condition()
+        self.stateWaiters = 0
+        # Set by _changingState
+        self.stateChanges = 0
 
         self.weakrefs[str(self.pipeline)] = self.pipeline
         if not self.pipeline:
@@ -532,7 +1836,9 @@ class GStreamerPipeline:
 
         self.running = False
         self.shouldRunThread = True
-        self.wasEverRunning = True
+        # The poller starts before the first state change now, so this can't
+        # default to True or it would see NULL and quit right away.
+        self.wasEverRunning = False
 
         self.knownThreads = {}
         self.startTime = 0
@@ -540,11 +1846,16 @@ class GStreamerPipeline:
         def dummy(*a, **k):
             _ = (a, k)
 
+        # Role -> scheduling settings, see set_scheduling()
+        self.scheduling = {}
+        # Native thread id -> what we know about it
+        self.threadRoles = {}
+        self._syncHandlerInstalled = False
+
         if realtime:
-            self._syncmessage = wrfunc(
-                weakref.WeakMethod(self.syncMessage), fail_return=Gst.BusSyncReply.PASS
-            )
-            self.bus.set_sync_handler(self._syncmessage, 0, dummy)
+            # realtime alone keeps the per thread setcurrent_threadPriority path,
+            # which subclasses may override.  set_scheduling() takes over from it.
+            self._installSyncHandler()
         self.pollthread = None
 
         self.lastElementType = None
@@ -587,6 +1898,7 @@ class GStreamerPipeline:
         skip=False,
     ):
         "Seek the pipeline to a position in seconds, set the playback rate, or both"
+        requested = time.monotonic()
         with self.lock:
             if self.exiting:
                 return
@@ -649,14 +1961,370 @@ class GStreamerPipeline:
                     )
                     e.set()
 
-            if sync:
-                f()
+            if sync:
+                f()
+            else:
+                doNow(f)
+            # If it got blocked because a race condition that made it paused, try to unblock
+            if not e.wait(0.5):
+                if not flush:
+                    self.pipeline.set_state(Gst.State.PLAYING)
+            else:
+                self.seek_stats["seek"].add(time.monotonic() - requested)
+
+    def scrub(self, t, accurate=False):
+        """Seek for UI scrubbers.  Returns immediately, and only the newest pending target is kept,
+        superseded ones are dropped.  Uses fast keyframe seeks unless accurate is set."""
+        with self._scrubLock:
+            if self.exiting or not self.running:
+                return
+            if self._scrubTarget is not None:
+                self.seek_stats["scrub"].dropped += 1
+            self._scrubTarget = (max(t, 0), time.monotonic(), accurate)
+            self._lastScrubPosition = max(t, 0)
+            self._scrubEvent.set()
+
+            if not self._scrubThread:
+                self._scrubThread = threading.Thread(
+                    target=makeWeakrefScrubber(weakref.ref(self)),
+                    daemon=True,
+                    name="nostartstoplog.GSTScrubber",
+                )
+                self._scrubThread.start()
+
+    def end_scrub(self, t=None):
+        "Finish scrubbing with an accurate seek, to t or to wherever the last scrub went"
+        if t is None:
+            t = self._lastScrubPosition
+        if t is not None:
+            self.scrub(t, accurate=True)
+
+    def _doPendingScrub(self):
+        with self._scrubLock:
+            target = self._scrubTarget
+            self._scrubTarget = None
+            self._scrubEvent.clear()
+
+        if target is None:
+            return
+        t, requested, accurate = target
+
+        flags = Gst.SeekFlags.FLUSH
+        if accurate:
+            flags |= Gst.SeekFlags.ACCURATE
+        else:
+            flags |= Gst.SeekFlags.KEY_UNIT | Gst.SeekFlags.SNAP_NEAREST
+
+        with self.seeklock:
+            if self.exiting or not self.running:
+                return
+            self.startTime = time.monotonic() - t
+            self.pipeline.seek(
+                self.targetRate,
+                Gst.Format.TIME,
+                flags,
+                Gst.SeekType.SET,
+                int(t * Gst.SECOND),
+                Gst.SeekType.NONE,
+                0,
+            )
+
+        # Flushing seeks preroll again, this returns once that is done.
+        # Without the lock, so new targets can come in meanwhile.
+        self.pipeline.get_state(5 * Gst.SECOND)
+        self.seek_stats["scrub"].add(time.monotonic() - requested)
+
+    def _on_qos(self, msg):
+        _, processed, dropped = msg.parse_qos_stats()
+        jitter, proportion, _ = msg.parse_qos_values()
+        q = self.qosStats.setdefault(
+            msg.src.get_name(),
+            {"messages": 0, "late": 0, "max_jitter": 0.0},
+        )
+        q["messages"] += 1
+        # Positive jitter means the buffer was late
+        if jitter > 0:
+            q["late"] += 1
+        q["jitter"] = jitter / 10**9
+        q["max_jitter"] = max(q["max_jitter"], jitter / 10**9)
+        q["proportion"] = proportion
+        q["processed"] = processed
+        q["dropped"] = dropped
+
+    def _probePads(self):
+        "Put a counting probe on every src pad not already counted, new ones appear at runtime"
+        for e in self.pipeline.iterate_elements():
+            for pad in e.srcpads:
+                key = e.get_name() + ":" + pad.get_name()
+                if key not in self.padCounters:
+                    c = PadCounter()
+                    pad.add_probe(
+                        Gst.PadProbeType.BUFFER | Gst.PadProbeType.BUFFER_LIST,
+                        c.probe,
+                    )
+                    self.padCounters[key] = c
+
+    def get_metrics(self):
+        """Pipeline state, buffers and bytes per second through each src pad, queue fill levels,
+        QoS stats per element, and the process RSS and CPU.  Rates are since the previous call."""
+        with self.lock:
+            self._probePads()
+            pads = {k: v.rates() for k, v in self.padCounters.items()}
+
+            queues = {}
+            for e in self.pipeline.iterate_elements():
+                f = e.get_factory()
+                if f and f.get_name() in ("queue", "queue2"):
+                    queues[e.get_name()] = queue_fill(e)
+
+            return {
+                "state": self.pipeline.get_state(0)[1].value_nick,
+                "pads": pads,
+                "queues": queues,
+                "qos": {k: dict(v) for k, v in self.qosStats.items()},
+                "process": self.processStats.sample(),
+            }
+
+    def set_metrics_push(self, interval=5.0):
+        "Push get_metrics() to the client's on_metrics every interval seconds, 0 to stop"
+        with self.lock:
+            self.metricsInterval = interval
+
+    def _pushMetrics(self):
+        if time.monotonic() - self.lastMetricsPush < self.metricsInterval:
+            return
+        self.lastMetricsPush = time.monotonic()
+        # Don't hold up the bus
+        if self.lock.acquire(blocking=False):
+            try:
+                m = self.get_metrics()
+            finally:
+                self.lock.release()
+            call_rpc_if_exists("_on_metrics", [m])
+
+    def set_watchdog(self, timeout=5.0, restart=True, max_restarts=3):
+        """Treat it as a stall if no buffer reaches any sink for timeout seconds while PLAYING.
+        Stalls are reported to the client's on_stall with diagnostics, and with restart set the
+        pipeline is restarted at the same position.  After max_restarts failed tries in a row,
+        or if a restart hangs, the client is told the process is unrecoverable.  0 disables it."""
+        with self.lock:
+            self.watchdogTimeout = timeout
+            self.watchdogRestart = restart
+            self.watchdogMaxRestarts = max_restarts
+            self.flowWatch.last = time.monotonic()
+            self.flowWatch.watch(self.pipeline)
+
+    def _stallDiagnostics(self, idle):
+        d = {
+            "idle": idle,
+            "time": time.time(),
+            "state": self.pipeline.get_state(0)[1].value_nick,
+            "threads": threading.active_count(),
+            "queues": {},
+        }
+        # A deadlocked seek or state change would be holding this
+        if self.lock.acquire(blocking=False):
+            self.lock.release()
+            d["lock_free"] = True
+        else:
+            d["lock_free"] = False
+        try:
+            ok, position = self.pipeline.query_position(Gst.Format.TIME)
+            d["position"] = position / 10**9 if ok else None
+        except Exception:
+            d["position"] = None
+        for e in self.pipeline.iterate_elements():
+            f = e.get_factory()
+            if f and f.get_name() in ("queue", "queue2"):
+                d["queues"][e.get_name()] = queue_fill(e)
+        return d
+
+    def _checkStall(self):
+        now = time.monotonic()
+        if self._recovering:
+            # Setting NULL can hang forever if a streaming thread is deadlocked
+            if (
+                now - self._recoveryStarted > self.watchdogTimeout + 10
+                and not self._gaveUp
+            ):
+                self._gaveUp = True
+                call_rpc_if_exists(
+                    "_on_unrecoverable",
+                    [{"reason": "Restart hung", "time": time.time()}],
+                )
+            return
+
+        if not self.running or self.exiting:
+            return
+        # New sinks may have been added at runtime
+        self.flowWatch.watch(self.pipeline)
+
+        # Paused isn't stalled, and shouldn't count toward it after resuming
+        if not self.pipeline.get_state(0)[1] == Gst.State.PLAYING:
+            self.flowWatch.last = now
+            return
+
+        idle = now - self.flowWatch.last
+        if idle > self.watchdogTimeout:
+            diagnostics = self._stallDiagnostics(idle)
+            log.warning(f"Pipeline stalled: {diagnostics}")
+            call_rpc_if_exists("_on_stall", [diagnostics])
+            if self.watchdogRestart:
+                self._recovering = True
+                self._recoveryStarted = now
+                threading.Thread(
+                    target=self._recoverFromStall,
+                    args=(diagnostics,),
+                    daemon=True,
+                    name="nostartstoplog.GSTRecovery",
+                ).start()
+            else:
+                # Report once per stall
+                self.flowWatch.last = now
+
+    def _recoverFromStall(self, diagnostics):
+        t = time.monotonic()
+        try:
+            self.watchdogRestarts += 1
+            if self.watchdogRestarts > self.watchdogMaxRestarts:
+                self._gaveUp = True
+                call_rpc_if_exists("_on_unrecoverable", [diagnostics])
+                return
+
+            # If whatever stalled us is holding the lock, restarting can't work
+            if not self.lock.acquire(timeout=2):
+                self._gaveUp = True
+                call_rpc_if_exists("_on_unrecoverable", [diagnostics])
+                return
+            try:
+                # Going to NULL on purpose, the poller shouldn't take it as the end
+                self.wasEverRunning = False
+                with self.seeklock:
+                    self.pipeline.set_state(Gst.State.NULL)
+                self._waitForState(Gst.State.NULL)
+                self.start()
+                if diagnostics.get("position"):
+                    try:
+                        self.seek(diagnostics["position"], sync=True)
+                    except Exception:
+                        # Live sources can't seek, and don't need to
+                        pass
+            finally:
+                self.lock.release()
+
+            if self._waitFor(lambda: self.flowWatch.last > t, self.watchdogTimeout):
+                self.watchdogRestarts = 0
+                call_rpc_if_exists("_on_recovery", ["restart", time.monotonic() - t])
+        except Exception:
+            log.exception("Error restarting stalled pipeline")
+        finally:
+            self.flowWatch.last = time.monotonic()
+            self._recovering = False
+
+    def set_profiling(self, enabled=True):
+        """Pause or resume collecting tracer records.  Only works if the pipeline was created with
+        profile set, tracers can't be added to a running GStreamer."""
+        if not self.profiler:
+            raise RuntimeError("Not started in profiling mode")
+        self.profiler.enabled = enabled
+
+    def get_profile(self):
+        """Histograms of per element processing time, and end to end latency per
+        source to sink path, in seconds"""
+        if not self.profiler:
+            raise RuntimeError("Not started in profiling mode")
+        return self.profiler.to_dict()
+
+    def reset_profile(self):
+        if self.profiler:
+            self.profiler.reset()
+
+    def set_drift_correction(
+        self,
+        enabled=True,
+        gain=0.1,
+        deadband=0.005,
+        max_adjust=0.005,
+        max_drift=0.5,
+        interval=1.0,
+    ):
+        """Configure the loop that keeps system_time pipelines on the system clock by nudging the rate.
+        gain is rate change per second of drift, clamped to +/- max_adjust.  Within deadband seconds
+        nothing is done, past max_drift it gives up and seeks."""
+        with self.lock:
+            if enabled:
+                self.driftController = DriftController(
+                    gain, deadband, max_adjust, max_drift
+                )
             else:
-                doNow(f)
-            # If it got blocked because a race condition that made it paused, try to unblock
-            if not e.wait(0.5):
-                if not flush:
-                    self.pipeline.set_state(Gst.State.PLAYING)
+                self.driftController = None
+            self.driftInterval = interval
+
+    def get_drift(self):
+        "Latest drift in seconds, positive is ahead, the rate in use, and counts of corrections"
+        return dict(self.drift_stats)
+
+    def _correctDrift(self):
+        if time.monotonic() - self.lastDriftCheck < self.driftInterval:
+            return
+        self.lastDriftCheck = time.monotonic()
+
+        # Sync groups are slaved to a shared clock, and changed rates have no reference
+        if not (self.system_time and self.running) or self.syncBaseTime is not None:
+            return
+        if not self.targetRate == 1.0:
+            return
+        if not self.pipeline.get_state(0)[1] == Gst.State.PLAYING:
+            return
+
+        # Don't hold up the bus for someone else's seek
+        if not self.seeklock.acquire(blocking=False):
+            return
+        try:
+            ok, position = self.pipeline.query_position(Gst.Format.TIME)
+            if not ok or position < 0:
+                return
+            drift = position / 10**9 - (time.monotonic() - self.startTime)
+
+            action, rate = self.driftController.update(drift, self.targetRate)
+            if action == "seek":
+                self.drift_stats["seeks"] += 1
+                # In this thread, we already hold the seeklock
+                self.seek(time.monotonic() - self.startTime, sync=True)
+                rate = self.targetRate
+            elif not rate == self.pipelineRate:
+                if self._setRateNoFlush(rate):
+                    self.drift_stats["rate_changes"] += 1
+                else:
+                    rate = self.pipelineRate
+        finally:
+            self.seeklock.release()
+
+        self.drift_stats["drift"] = drift
+        self.drift_stats["rate"] = rate
+        call_rpc_if_exists("on_drift", [drift, rate])
+
+    def _setRateNoFlush(self, rate):
+        "Change the rate without flushing, so audio doesn't glitch"
+        # Newer GStreamer can do it without even a new segment from upstream
+        instant = getattr(Gst.SeekFlags, "INSTANT_RATE_CHANGE", None)
+        for flags in ([instant] if instant else []) + [Gst.SeekFlags.NONE]:
+            if self.pipeline.seek(
+                rate,
+                Gst.Format.TIME,
+                flags,
+                Gst.SeekType.NONE,
+                0,
+                Gst.SeekType.NONE,
+                0,
+            ):
+                self.pipelineRate = rate
+                return True
+        return False
+
+    def get_seek_stats(self):
+        "Latency from request to completion, in seconds, for seek() and scrub()"
+        return {k: v.to_dict() for k, v in self.seek_stats.items()}
 
     def getPosition(self):
         "Returns stream position in seconds"
@@ -672,7 +2340,61 @@ class GStreamerPipeline:
 
     @staticmethod
     def setcurrent_threadPriority(x, y):
-        raise RuntimeError("Must override this to use realtime priority")
+        "Give the calling thread SCHED_FIFO priority y.  Subclasses may override it"
+        _ = x
+        if sched_tools.apply(threading.get_native_id(), "fifo", y):
+            raise RuntimeError("Could not set realtime priority")
+
+    def _installSyncHandler(self):
+        if not self._syncHandlerInstalled:
+            self._syncmessage = wrfunc(
+                weakref.WeakMethod(self.syncMessage), fail_return=Gst.BusSyncReply.PASS
+            )
+            self.bus.set_sync_handler(self._syncmessage, 0, None)
+            self._syncHandlerInstalled = True
+
+    def set_scheduling(self, roles):
+        """Scheduling for streaming threads, by role.  roles maps a role name to a dict of
+        policy ("fifo", "rr", "other", "batch", "idle"), priority, nice and cpus, a list of CPU numbers.
+
+        Roles are audio_sink, video_sink, sink, decoder, encoder, analysis, source and other,
+        "default" applies to any role not listed.  Queues get the role of what they feed.
+        Call before start(), threads only get placed as they first start streaming.
+        Anything the process isn't allowed to do is skipped with a warning."""
+        with self.lock:
+            self.scheduling = dict(roles)
+            if roles:
+                self._installSyncHandler()
+
+    def get_thread_stats(self):
+        """Every thread in this process with CPU time in seconds, last CPU, policy, priority,
+        nice and affinity, plus role, element and failed settings for the streaming threads."""
+        stats = sched_tools.thread_stats()
+        for i in stats:
+            info = self.threadRoles.get(i["tid"])
+            if info:
+                i.update(info)
+        return stats
+
+    def _placeStreamingThread(self, owner):
+        "Called in a streaming thread as it starts, with the element that owns it"
+        tid = threading.get_native_id()
+        role = thread_role(owner)
+        settings = self.scheduling.get(role, self.scheduling.get("default"))
+        failed = []
+        if settings:
+            failed = sched_tools.apply(
+                tid,
+                settings.get("policy"),
+                settings.get("priority", 0),
+                settings.get("nice"),
+                settings.get("cpus"),
+            )
+        self.threadRoles[tid] = {
+            "role": role,
+            "element": owner.get_name() if owner else None,
+            "failed": failed,
+        }
 
     def syncMessage(self, *arguments):
         "Synchronous message, so we can enable realtime priority on individual threads."
@@ -680,17 +2402,32 @@ class GStreamerPipeline:
         # Wait till we have at least one thread though.
 
         try:
-            if self.knownThreads and time.monotonic() - self.startTime > 3:
+            # Unless we are placing threads, that has to catch them whenever they start
+            if (
+                self.knownThreads
+                and not self.scheduling
+                and time.monotonic() - self.startTime > 3
+            ):
                 # This can't use the lock, we don't know what thread it might be called in.
                 def noSyncHandler():
                     with self.lock:
                         if hasattr(self, "bus"):
                             self.bus.set_sync_handler(None, 0, None)
+                            self._syncHandlerInstalled = False
 
                 doNow(noSyncHandler)
-            if threading.current_thread().ident not in self.knownThreads:
+            msg = arguments[1]
+            if msg.type == Gst.MessageType.STREAM_STATUS:
+                status, owner = msg.parse_stream_status()
+                # Posted from the streaming thread itself as its task starts
+                if status == Gst.StreamStatusType.ENTER:
+                    if threading.get_native_id() not in self.threadRoles:
+                        self._placeStreamingThread(owner)
+
+            elif threading.current_thread().ident not in self.knownThreads:
                 self.knownThreads[threading.current_thread().ident] = True
-                if self.realtime:
+                # Legacy path, for subclasses that override setcurrent_threadPriority
+                if self.realtime and not self.scheduling:
                     try:
                         self.setcurrent_threadPriority(1, self.realtime)
                     except Exception:
@@ -722,20 +2459,11 @@ class GStreamerPipeline:
 
     def __del__(self):
         self.running = False
-        t = time.monotonic()
 
-        # Give it some time, in case it really was started
-        if not self.thread_started:
-            time.sleep(0.01)
-            time.sleep(0.01)
-            time.sleep(0.01)
-            time.sleep(0.01)
-
-        if self.thread_started:
-            while not self.exitSignal:
-                time.sleep(0.1)
-                if time.monotonic() - t > 10:
-                    raise RuntimeError("Timeout")
+        # If the thread was ever started it sets this on the way out
+        if self.pollthread:
+            if not self.exitSignal.wait(10):
+                raise RuntimeError("Timeout")
 
         if not self._stopped:
             self.stop()
@@ -755,10 +2483,34 @@ class GStreamerPipeline:
     #     call_rpc_if_exists("_on_appsink_data", [str(user_data), base64.b64encode(buffer_map.data).decode()])
     #     return Gst.FlowReturn.OK
 
+    def set_metering(self, enabled=True, window=0.25):
+        """Batch level and spectrum messages into one on_meter_update per window, instead of
+        one on_level_message per message."""
+        with self.lock:
+            if enabled:
+                self.meter = Meter(window)
+            else:
+                self.meter = None
+
+    def _flush_meter(self, force=False):
+        m = self.meter
+        if m and (force or m.due()):
+            update = m.flush()
+            if update:
+                call_rpc_if_exists("_on_meter_update", [update])
+
     def on_message(self, src, name, s):
-        if s.get_name() == "level":
-            rms = sum([i for i in s["rms"]]) / len(s["rms"])
-            decay = sum([i for i in s["decay"]]) / len(s["decay"])
+        if s.get_name() == "level" and self.meter:
+            self.meter.add_level(src.get_name(), s)
+            self._flush_meter()
+
+        elif s.get_name() == "spectrum" and self.meter:
+            self.meter.add_spectrum(src.get_name(), s)
+            self._flush_meter()
+
+        elif s.get_name() == "level":
+            rms = mean_db(list(s["rms"]))
+            decay = mean_db(list(s["decay"]))
             call_rpc_if_exists("on_level_message", [str(src), rms, decay])
 
         elif s.get_name() == "motion":
@@ -803,6 +2555,19 @@ class GStreamerPipeline:
         _ = bus, userdata
         with self.lock:
             logging.debug("Error {}: {}, {}".format(msg.src.name, *msg.parse_error()))
+        # The publisher went away, keep the rest of the pipeline going and wait for it
+        if msg.src in self.subscribedStreams:
+            # The shmsrc may post several errors for one outage, only one thread should handle it
+            with self.lock:
+                if msg.src in self.resubscribing:
+                    return
+                self.resubscribing.add(msg.src)
+            threading.Thread(
+                target=self._resubscribe,
+                args=(msg.src,),
+                daemon=True,
+                name="nostartstoplog.IceflowResubscribe",
+            ).start()
 
     def _on_segment_done(self, *a):
         with self.lock:
@@ -814,17 +2579,57 @@ class GStreamerPipeline:
         # As that is usually not what you want when doing seamless loops.
         call_rpc_if_exists("on_segment_done", [])
 
-    def _waitForState(self, s, timeout=10):
+    def _waitFor(self, f, timeout=10):
+        """Wait until f() is true, rechecking each time the poller sees a bus message.
+        Returns False on timeout."""
         t = time.monotonic()
-        i = 0.01
-        while not self.pipeline.get_state(1000_000_000)[1] == s:
-            if time.monotonic() - t > timeout:
-                raise RuntimeError(
-                    "Timeout, pipeline still in: ",
-                    self.pipeline.get_state(1000_000_000)[1],
-                )
-            time.sleep(min(i, 0.1))
-            i *= 2
+        poller = self.pollthread
+        usePoller = (
+            poller
+            and poller.is_alive()
+            and poller is not threading.current_thread()
+            and not self.exitSignal.is_set()
+        )
+
+        with self.stateCondition:
+            self.stateWaiters += 1
+            try:
+                while True:
+                    # Checked with the condition held so we can't miss a notify
+                    if f():
+                        return True
+                    remaining = timeout - (time.monotonic() - t)
+                    if remaining <= 0:
+                        return False
+                    if usePoller:
+                        # The timeout is only a backstop, not every change posts a message
+                        self.stateCondition.wait(min(remaining, 0.5))
+                    else:
+                        # Nobody to wake us, let GStreamer block on any pending async change
+                        self.stateCondition.release()
+                        try:
+                            self.pipeline.get_state(
+                                int(min(remaining, 0.1) * Gst.SECOND)
+                            )
+                        finally:
+                            self.stateCondition.acquire()
+            finally:
+                self.stateWaiters -= 1
+
+    def _waitForState(self, s, timeout=10):
+        # get_state(0) never blocks, it just reports the current state
+        if not self._waitFor(lambda: self.pipeline.get_state(0)[1] == s, timeout):
+            raise RuntimeError(
+                "Timeout, pipeline still in: ",
+                self.pipeline.get_state(0)[1],
+            )
+
+    def _hasValidPosition(self):
+        try:
+            self.getPosition()
+            return True
+        except Exception:
+            return False
 
     def exitSegmentMode(self):
         with self.lock:
@@ -835,6 +2640,8 @@ class GStreamerPipeline:
         def f():
             with self.lock:
                 if not self.pipeline.get_state(1000_000_000)[1] == Gst.State.NULL:
+                    # Going to NULL on purpose, the poller shouldn't take it as the end
+                    self.wasEverRunning = False
                     with self.seeklock:
                         self.pipeline.set_state(Gst.State.NULL)
                     self._waitForState(Gst.State.NULL)
@@ -845,55 +2652,67 @@ class GStreamerPipeline:
     def start(self, effectiveStartTime=None, timeout=10, segment=False):
         "effectiveStartTime is used to keep multiple players synced when used with system_time"
         with self.lock:
-            if self.exiting:
-                return
-
-            x = effectiveStartTime or time.time()
-            timeAgo = time.time() - x
-            # Convert to monotonic time that the nternal APIs use
-            self.startTime = time.monotonic() - timeAgo
-
-            # Go straight to playing, no need to locally do paused if we aren't using that feature
-            if self.system_time or effectiveStartTime or segment:
-                if not self.pipeline.get_state(1000_000_000)[1] == (
-                    Gst.State.PAUSED,
-                    Gst.State.PLAYING,
-                ):
-                    with self.seeklock:
-                        self.pipeline.set_state(Gst.State.PAUSED)
-                    self._waitForState(Gst.State.PAUSED)
-
-            # Seek to where we should be, if we had actually
-            # Started when we should have. We want to get everything set up in the pause state
-            # First so we have the right "effective" start time.
-
-            # We accept cutting off a few 100 milliseconds if it means
-            # staying synced.
-            if self.system_time:
-                self.seek(time.monotonic() - self.startTime)
-
-            elif segment:
-                self.seek(0, segment=True, flush=True)
+            with self._changingState():
+                if self.exiting:
+                    return
 
-            with self.seeklock:
-                self.pipeline.set_state(Gst.State.PLAYING)
+                x = effectiveStartTime or time.time()
+                timeAgo = time.time() - x
+                # Convert to monotonic time that the nternal APIs use
+                self.startTime = time.monotonic() - timeAgo
+
+                # Running before the first state change, it's what wakes up the waits
+                self.maybeStartPoller()
+
+                # Go straight to playing, no need to locally do paused if we aren't using that feature
+                grouped = self.syncBaseTime is not None
+                if self.system_time or effectiveStartTime or segment or grouped:
+                    if not self.pipeline.get_state(1000_000_000)[1] == (
+                        Gst.State.PAUSED,
+                        Gst.State.PLAYING,
+                    ):
+                        with self.seeklock:
+                            self.pipeline.set_state(Gst.State.PAUSED)
+                        self._waitForState(Gst.State.PAUSED)
+
+                # Seek to where we should be, if we had actually
+                # Started when we should have. We want to get everything set up in the pause state
+                # First so we have the right "effective" start time.
+
+                # We accept cutting off a few 100 milliseconds if it means
+                # staying synced.
+                # Where a flushing seek put running time zero, in stream time
+                seeked = 0
+                if grouped:
+                    # Joining late, start where the rest of the group already is
+                    elapsed = self.groupClock.get_time() - self.syncBaseTime
+                    if elapsed > 0:
+                        self.running = True
+                        # No lookahead offset, the base time has to match the seek exactly
+                        self.seek(elapsed / 10**9, sync=True, _offset=0)
+                        seeked = elapsed
+
+                elif self.system_time:
+                    self.seek(time.monotonic() - self.startTime)
+
+                elif segment:
+                    self.seek(0, segment=True, flush=True)
 
-            self._waitForState(Gst.State.PLAYING, timeout)
+                with self.seeklock:
+                    if grouped:
+                        # Keep the group's base time instead of picking a new one on the way to PLAYING.
+                        # The seek restarted running time at the seek position, so that much later.
+                        self.pipeline.set_start_time(Gst.CLOCK_TIME_NONE)
+                        self.pipeline.set_base_time(self.syncBaseTime + seeked)
+                    self.pipeline.set_state(Gst.State.PLAYING)
 
-            self.running = True
+                self._waitForState(Gst.State.PLAYING, timeout)
 
-            for i in range(500):
-                try:
-                    # Test that we can actually read the clock
-                    self.getPosition()
-                    break
-                except Exception:
-                    if i > 150:
-                        raise RuntimeError("Clock still not valid")
-                    time.sleep(0.1)
+                self.running = True
 
-            # Don't start the thread until we have a valid clock
-            self.maybeStartPoller()
+                # Test that we can actually read the clock
+                if not self._waitFor(self._hasValidPosition, 15):
+                    raise RuntimeError("Clock still not valid")
 
     def play(self, segment=False):
         with self.lock:
@@ -918,17 +2737,175 @@ class GStreamerPipeline:
             if segment:
                 self.seek(segment=True, flush=False)
 
+    @contextlib.contextmanager
+    def _changingState(self):
+        """Held with the lock through start, pause and prepare, so the poller doesn't take the lock
+        being held for a jammed seek and force PLAYING in the middle of one."""
+        self.stateChanges += 1
+        try:
+            yield
+        finally:
+            self.stateChanges -= 1
+
     def pause(self):
         "Not that we can start directly into paused without playing first, to preload stuff"
+        with self.lock:
+            with self._changingState():
+                if self.exiting:
+                    return
+                self.maybeStartPoller()
+                with self.seeklock:
+                    self.pipeline.set_state(Gst.State.PAUSED)
+                self._waitForState(Gst.State.PAUSED)
+                self.getPosition()
+                self.running = True
+
+    def serve_clock(self, port=0, address="127.0.0.1"):
+        """Publish this pipeline's clock on the network so other pipelines can join_clock() it.
+        The system clock is used, so the time is valid before starting.  Returns the port."""
+        GstNet = get_gst_net()
+        with self.lock:
+            if not self.clockProvider:
+                clock = Gst.SystemClock.obtain()
+                self.pipeline.use_clock(clock)
+                self.groupClock = clock
+                self.clockProvider = GstNet.NetTimeProvider.new(clock, address, port)
+            return self.clockProvider.props.port
+
+    def join_clock(self, address, port, timeout=5):
+        "Slave this pipeline to a clock published by serve_clock()"
+        GstNet = get_gst_net()
+        with self.lock:
+            clock = GstNet.NetClientClock.new("iceflow", address, port, 0)
+            if not clock.wait_for_sync(int(timeout * Gst.SECOND)):
+                raise RuntimeError(f"Could not sync to clock at {address}:{port}")
+            self.pipeline.use_clock(clock)
+            self.groupClock = clock
+
+    def get_clock_time(self):
+        "Current time of the group clock in nanoseconds"
+        with self.lock:
+            if self.groupClock is None:
+                raise RuntimeError(
+                    "Not in a sync group, call serve_clock() or join_clock()"
+                )
+            return self.groupClock.get_time()
+
+    def sync_start(self, base_time, timeout=10):
+        """Start with a base time shared by the whole group, so every member plays the same
+        stream time at the same instant, with no corrective seeks."""
+        with self.lock:
+            if self.groupClock is None:
+                raise RuntimeError(
+                    "Not in a sync group, call serve_clock() or join_clock()"
+                )
+            self.syncBaseTime = base_time
+            self.start(timeout=timeout)
+
+    def get_sync_offset(self):
+        """Group clock time since the group base time, minus the stream position, in seconds.
+        Members that are in sync all report the same value."""
+        with self.lock:
+            clock = self.pipeline.get_clock() or self.groupClock
+            now = clock.get_time()
+            ok, position = self.pipeline.query_position(Gst.Format.TIME)
+            if not ok:
+                raise RuntimeError("Could not get position")
+            # A late joiner's own base time is moved by its seek, the group's base time is not
+            base = self.syncBaseTime
+            if base is None:
+                base = self.pipeline.get_base_time()
+            return (now - base - position) / 10**9
+
+    def prepare(self, t=0, timeout=10):
+        """Preroll to PAUSED and seek to t, so that go() only has to change state.
+        While parked the streaming threads are blocked in the sinks and use no CPU."""
+        requested = time.monotonic()
+        with self.lock:
+            with self._changingState():
+                if self.exiting:
+                    return
+                self.maybeStartPoller()
+                # An unfired go probe would take the preroll buffer for its own
+                self._disarmFirstBuffer()
+                with self.seeklock:
+                    self.pipeline.set_state(Gst.State.PAUSED)
+                self._waitForState(Gst.State.PAUSED, timeout)
+                self.running = True
+
+                if t:
+                    self.seek(t, sync=True)
+
+                # A flushing seek loses the preroll, wait till the sinks have a buffer again.
+                # Live sources can't preroll at all and report NO_PREROLL instead.
+                def prerolled():
+                    r = self.pipeline.get_state(0)
+                    return (
+                        r[0] != Gst.StateChangeReturn.ASYNC and r[1] == Gst.State.PAUSED
+                    )
+
+                if not self._waitFor(prerolled, timeout):
+                    raise RuntimeError("Timeout waiting for preroll")
+
+                self.cuePosition = t
+                self.prepared = True
+                # Measured here rather than by a probe, live sources never preroll a buffer
+                latency = time.monotonic() - requested
+                self.cue_stats["prepare"].add(latency)
+                call_rpc_if_exists("on_cue_latency", ["prepare", latency])
+
+    def go(self):
+        """Start a pipeline parked by prepare().  Only changes state, doesn't wait.
+        Latency until the next buffer reaches a sink is reported to on_cue_latency and get_cue_stats."""
+        requested = time.monotonic()
         with self.lock:
             if self.exiting:
                 return
+            if not self.prepared:
+                raise RuntimeError("Pipeline is not prepared, call prepare()")
+            self.prepared = False
+
+            # Position the cue would be at now, for system_time sync
+            self.startTime = requested - self.cuePosition
+            self._armFirstBuffer("go", requested)
             with self.seeklock:
-                self.pipeline.set_state(Gst.State.PAUSED)
-            self._waitForState(Gst.State.PAUSED)
-            self.getPosition()
-            self.running = True
-            self.maybeStartPoller()
+                self.pipeline.set_state(Gst.State.PLAYING)
+
+    def get_cue_stats(self):
+        """Latency in seconds of prepare() until prerolled, and of go() until the first buffer
+        after the prerolled one reaches a sink"""
+        return {k: v.to_dict() for k, v in self.cue_stats.items()}
+
+    def _disarmFirstBuffer(self):
+        for pad, probe, fired in self._firstBufferProbes:
+            if pad not in fired:
+                pad.remove_probe(probe)
+        self._firstBufferProbes = []
+
+    def _armFirstBuffer(self, kind, requested):
+        "Time from requested until the first buffer reaches any sink, reported once"
+        self._disarmFirstBuffer()
+
+        selfref = weakref.ref(self)
+        done = threading.Lock()
+        # Pads whose probe already removed itself
+        fired = set()
+
+        def probe(pad, info):
+            fired.add(pad)
+            if done.acquire(blocking=False):
+                latency = time.monotonic() - requested
+                self = selfref()
+                if self:
+                    self.cue_stats[kind].add(latency)
+                    call_rpc_if_exists("on_cue_latency", [kind, latency])
+            return Gst.PadProbeReturn.REMOVE
+
+        for sink in self.pipeline.iterate_sinks():
+            for pad in sink.sinkpads:
+                self._firstBufferProbes.append(
+                    (pad, pad.add_probe(Gst.PadProbeType.BUFFER, probe), fired)
+                )
 
     def maybeStartPoller(self, join=False):
         if not self.pollthread:
@@ -956,6 +2933,12 @@ class GStreamerPipeline:
             # Could hold the lock and we could never stop it.
             self.shouldRunThread = False
 
+            # Nothing will ever ask for more data now, don't leave producers blocked
+            for i in self.appsources:
+                i.close()
+            for i in list(self.shm_feeders.values()):
+                i.close()
+
             if not self.exiting:
                 if hasattr(self, "pipeline"):
                     with self.seeklock:
@@ -984,25 +2967,20 @@ class GStreamerPipeline:
                 # This might fail, if it never even started, but we just kinda ignore that.p
                 self.running = False
                 self.shouldRunThread = False
-                t = time.monotonic()
-                time.sleep(0.01)
 
-                if not self.thread_started:
-                    time.sleep(0.01)
-                    time.sleep(0.01)
-                    time.sleep(0.01)
-                    time.sleep(0.01)
-
-                # On account of the race condition, it is possible that the thread actually never did start yet
-                # So we have to ignore the exit flag stuff.
+                # If the thread was ever started, it sets the signal on the way out.
+                # Wake it up so it doesn't sit out the rest of its timed_pop.
+                if self.pollthread:
+                    self.bus.post(
+                        Gst.Message.new_application(
+                            self.pipeline, Gst.Structure.new_empty("iceflow-wake")
+                        )
+                    )
 
                 # It shouldn't really be critical, most likely the thread can stop on it's own time anyway,
                 # because it doesn't do anything without getting the lock.
-                if self.thread_started:
-                    while not self.exitSignal:
-                        time.sleep(0.1)
-                        if time.monotonic() - t > 10:
-                            break
+                if self.pollthread:
+                    self.exitSignal.wait(10)
 
                 with self.lock:
                     if self._stopped:
@@ -1035,9 +3013,20 @@ class GStreamerPipeline:
 
                     doNow(f)
 
+                    # Nothing is streaming now, safe to drop the shared memory
+                    for i in self.audio_taps:
+                        i.close()
+                    # Whatever was being recorded still gets a proper index
+                    for i in self.recorders:
+                        i.close()
+                    for i in self.publishedStreams:
+                        with contextlib.suppress(OSError):
+                            os.unlink(stream_paths(i)[1])
+
                     self._stopped = True
         finally:
             stopflag[0] = 1
+            wake_main()
 
     def add_pil_capture(
         self, resolution=None, connect_to_output=None, buffer=1, method=1
@@ -1065,53 +3054,485 @@ class GStreamerPipeline:
     def addRemotePILCapture(self, *a, **k):
         return id(self.add_pil_capture(*a, **k))
 
-    def addPILSource(self, resolution, buffer=1, greyscale=False):
-        "Return a video source object that we can use to put PIL buffers into the stream"
+    def add_frame_stream(
+        self, fmt="jpeg", max_fps=None, connect_to_output=None, quality=85
+    ):
+        """Encode frames once and push them to the client as they are produced.
+        Rate limiting happens here with videorate, so dropped frames are never encoded."""
+        if fmt not in frame_stream_formats:
+            raise ValueError("Unsupported frame stream format: " + str(fmt))
+
+        encoder, caps = frame_stream_formats[fmt]
+
+        # videorate's max-rate is a whole number of frames per second
+        if max_fps is not None and max_fps < 1:
+            raise ValueError("max_fps must be at least 1, got " + str(max_fps))
+
+        if max_fps:
+            self.add_element(
+                "videorate",
+                drop_only=True,
+                max_rate=int(max_fps),
+                connect_to_output=connect_to_output,
+            )
+            connect_to_output = None
+
+        self.add_element("videoconvert", connect_to_output=connect_to_output)
+
+        if encoder == "jpegenc":
+            self.add_element(encoder, quality=quality)
+        elif encoder:
+            self.add_element(encoder)
+        else:
+            self.add_element("capsfilter", caps=caps)
+
+        appsink = self.add_element(
+            "appsink",
+            caps=caps,
+            emit_signals=True,
+            drop=True,
+            sync=False,
+            max_buffers=1,
+        )
+
+        s = FrameStream(appsink, fmt)
+        elementsByShortId[id(s)] = s
+        self.frame_streams.append(s)
+        return s
+
+    def addRemoteFrameStream(self, *a, **k):
+        return id(self.add_frame_stream(*a, **k))
+
+    def set_frame_stream_active(self, stream, active):
+        "The client turns this on when something subscribes, and off when the last subscriber leaves"
+        if isinstance(stream, int):
+            stream = elementsByShortId[stream]
+        stream.active = bool(active)
+
+    def add_audio_tap(
+        self, ring_name, block_size=1024, channels=2, connect_to_output=None
+    ):
+        """Deliver raw float32 audio to the client in blocks of block_size frames,
+        through a shared memory ring the client created.
+
+        With no connect_to_output, a tee is added to the main chain and the tap hangs off it.
+        If connect_to_output is a tee, the tap becomes a new branch of it.
+        """
+        if connect_to_output is None:
+            src = self.add_element("tee")
+        else:
+            src = connect_to_output
+            if isinstance(src, int):
+                src = elementsByShortId[src]
+
+        # Leaky, so a slow tap never stalls the main branch
+        q = self.add_element(
+            "queue",
+            leaky=2,
+            max_size_buffers=4,
+            max_size_time=0,
+            max_size_bytes=0,
+            connect_to_output=src,
+            sidechain=True,
+        )
+        c = self.add_element(
+            "audioconvert",
+            connect_to_output=q,
+            sidechain=True,
+        )
+        f = self.add_element(
+            "capsfilter",
+            caps="audio/x-raw,format=F32LE,layout=interleaved,channels="
+            + str(int(channels)),
+            connect_to_output=c,
+            sidechain=True,
+        )
+        appsink = self.add_element(
+            "appsink",
+            emit_signals=True,
+            sync=False,
+            connect_to_output=f,
+            sidechain=True,
+        )
+
+        t = AudioTap(appsink, get_shm_ring().attach(ring_name), block_size, channels)
+        elementsByShortId[id(t)] = t
+        self.audio_taps.append(t)
+        return t
+
+    def addRemoteAudioTap(self, *a, **k):
+        return id(self.add_audio_tap(*a, **k))
+
+    def add_pretrigger_recorder(
+        self,
+        pre_roll=5.0,
+        post_roll=5.0,
+        max_bytes=64 * 1024 * 1024,
+        encoder="x264enc",
+        mux="matroskamux",
+        connect_to_output=None,
+    ):
+        """Keep the last pre_roll seconds of encoded video in memory, at most max_bytes, ready for
+        trigger_recording.  With encoder=None the input must already be encoded, like from a camera's
+        own H.264 stream.  With no connect_to_output a tee is added to the main chain, as for taps."""
+        if connect_to_output is None:
+            src = self.add_element("tee")
+        else:
+            src = connect_to_output
+            if isinstance(src, int):
+                src = elementsByShortId[src]
+
+        # Leaky, so encoding falling behind never stalls the main branch
+        last = self.add_element(
+            "queue",
+            leaky=2,
+            max_size_time=Gst.SECOND,
+            max_size_buffers=0,
+            max_size_bytes=0,
+            connect_to_output=src,
+            sidechain=True,
+        )
+        if encoder:
+            last = self.add_element(
+                "videoconvert", connect_to_output=last, sidechain=True
+            )
+            kw = {}
+            if encoder == "x264enc":
+                # Short GOPs, so the pre-roll can start close to where it should
+                kw = {"tune": "zerolatency", "key_int_max": 30}
+            last = self.add_element(
+                encoder, connect_to_output=last, sidechain=True, **kw
+            )
+            if encoder == "x264enc":
+                # What muxers want, rather than byte-stream
+                last = self.add_element(
+                    "capsfilter",
+                    caps="video/x-h264,stream-format=avc,alignment=au",
+                    connect_to_output=last,
+                    sidechain=True,
+                )
+        appsink = self.add_element(
+            "appsink",
+            emit_signals=True,
+            sync=False,
+            connect_to_output=last,
+            sidechain=True,
+        )
+
+        r = PreTriggerRecorder(appsink, pre_roll, post_roll, max_bytes, mux)
+        elementsByShortId[id(r)] = r
+        self.recorders.append(r)
+        return r
+
+    def addRemotePreTriggerRecorder(self, *a, **k):
+        return id(self.add_pretrigger_recorder(*a, **k))
+
+    def trigger_recording(self, recorder, filename):
+        if isinstance(recorder, int):
+            recorder = elementsByShortId[recorder]
+        return recorder.trigger(filename)
+
+    def release_recording(self, recorder):
+        if isinstance(recorder, int):
+            recorder = elementsByShortId[recorder]
+        recorder.release()
+
+    def get_recorder_stats(self, recorder):
+        if isinstance(recorder, int):
+            recorder = elementsByShortId[recorder]
+        with recorder.lock:
+            return dict(
+                recorder.stats,
+                recording=bool(recorder.writer),
+                buffered_bytes=recorder.ring_bytes,
+            )
+
+    def get_audio_tap_stats(self, tap):
+        if isinstance(tap, int):
+            tap = elementsByShortId[tap]
+        return {"blocks": tap.blocks, "overruns": tap.overruns}
 
+    def add_app_source(
+        self, caps, framerate=None, max_bytes=4 * 1024 * 1024, is_live=False
+    ):
+        """Return a flow controlled AppSource. Pushes block once max_bytes are queued,
+        and if framerate is set, buffers get timestamps."""
         appsrc = self.add_element(
-            "appsrc",
-            caps="video/x-raw,width="
-            + str(resolution[0])
-            + ",height="
-            + str(resolution[0])
-            + ", format="
-            + "GREy8"
-            if greyscale
-            else "RGB",
-            connect_to_output=False,
+            "appsrc", caps=caps, is_live=is_live, connect_to_output=False
+        )
+        s = AppSource(appsrc, framerate, max_bytes)
+        elementsByShortId[id(s)] = s
+        self.appsources.append(s)
+        return s
+
+    def addRemoteAppSource(self, *a, **k):
+        return id(self.add_app_source(*a, **k))
+
+    def publish_stream(self, name, connect_to_output=None, **kwargs):
+        """Make the data at this point available to other iceflow processes, through a shmsink.
+        Any number can subscribe_stream(name), and they can come and go while this one plays.
+        kwargs are shmsink properties, like shm_size, which must hold a few buffers."""
+        sock_path, caps_path = stream_paths(name)
+        # When rebuilding, the old process may take a moment to die
+        t = time.monotonic()
+        while socket_listening(sock_path):
+            if time.monotonic() - t > 1:
+                raise ValueError("Stream is already published: " + name)
+            time.sleep(0.05)
+        # Leftovers from a publisher that crashed
+        for i in (sock_path, caps_path):
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(i)
+
+        kwargs.setdefault("wait_for_connection", False)
+        sink = self.add_element(
+            "shmsink",
+            socket_path=sock_path,
+            connect_to_output=connect_to_output,
+            **kwargs,
+        )
+
+        # Subscribers need the caps, shm only carries the bytes
+        def probe(pad, info):
+            e = info.get_event()
+            if e.type == Gst.EventType.CAPS:
+                tmp = caps_path + ".tmp"
+                with open(tmp, "w") as f:
+                    f.write(e.parse_caps().to_string())
+                os.replace(tmp, caps_path)
+            return Gst.PadProbeReturn.OK
+
+        sink.get_static_pad("sink").add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, probe)
+        self.publishedStreams[name] = sink
+        return sink
+
+    def subscribe_stream(self, name, timeout=10, connect_to_output=False):
+        """Add a source that plays a stream another process published.  Waits up to timeout for it
+        to exist.  If the publisher restarts, this reconnects, and the rest of the pipeline keeps going.
+        Returns the capsfilter after the shmsrc, which is what later elements link to."""
+        sock_path, _ = stream_paths(name)
+        t = time.monotonic()
+        caps = read_stream_caps(name)
+        while not caps:
+            if time.monotonic() - t > timeout:
+                raise ValueError("Stream was never published: " + name)
+            time.sleep(0.05)
+            caps = read_stream_caps(name)
+
+        src = self.add_element(
+            "shmsrc",
+            socket_path=sock_path,
+            is_live=True,
+            do_timestamp=True,
+            connect_to_output=connect_to_output,
+        )
+        f = self.add_element("capsfilter", caps=caps, connect_to_output=src)
+
+        # shmsrc sends EOS when the publisher goes away, which would end this pipeline for good.
+        # Drop it, _resubscribe brings the source back instead.
+        def probe(pad, info):
+            if info.get_event().type == Gst.EventType.EOS:
+                return Gst.PadProbeReturn.DROP
+            return Gst.PadProbeReturn.OK
+
+        src.get_static_pad("src").add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, probe)
+        self.subscribedStreams[src] = (name, f)
+        return f
+
+    def _resubscribe(self, src):
+        "Wait for a publisher to come back, then restart the shmsrc, picking up new caps if any"
+        try:
+            name, capsfilter = self.subscribedStreams[src]
+            src.set_state(Gst.State.NULL)
+            while self.shouldRunThread and not self.exiting:
+                caps = read_stream_caps(name)
+                if caps:
+                    capsfilter.set_property("caps", registry.caps(caps))
+                    if src.sync_state_with_parent():
+                        call_rpc_if_exists("on_stream_reconnect", [name])
+                        return
+                    src.set_state(Gst.State.NULL)
+                time.sleep(0.25)
+        finally:
+            with self.lock:
+                self.resubscribing.discard(src)
+
+    def add_compositor(
+        self,
+        width=1280,
+        height=720,
+        framerate=None,
+        background="black",
+        connect_to_output=False,
+    ):
+        """Add a compositor that mixes any number of video inputs into one width x height output,
+        so a video wall is one pipeline instead of one per camera.  Elements added after this link
+        to its output.  Returns the compositor, for add_compositor_input and set_compositor_layout."""
+        comp = self.add_element(
+            "compositor", background=background, connect_to_output=connect_to_output
+        )
+        caps = f"video/x-raw,width={int(width)},height={int(height)}"
+        if framerate:
+            f = fractions.Fraction(framerate).limit_denominator(1001)
+            caps += f",framerate={f.numerator}/{f.denominator}"
+        self.add_element("capsfilter", caps=caps, connect_to_output=comp)
+        self.compositors[comp] = {"size": (int(width), int(height)), "pads": []}
+        return comp
+
+    def add_compositor_input(self, compositor, source, grid=True):
+        """Feed a source element, like a decodebin or a camera, into a new compositor pad,
+        through a queue so each input gets its own thread.  Dynamic pads are linked when they appear.
+        With grid, the layout is redone as an even grid of every input.  Returns the input index."""
+        if isinstance(compositor, int):
+            compositor = elementsByShortId[compositor]
+        if isinstance(source, int):
+            source = elementsByShortId[source]
+
+        with self.lock:
+            info = self.compositors[compositor]
+            # Nothing to link yet on a decodebin or similar
+            dynamic = any(
+                t.direction == Gst.PadDirection.SRC
+                and t.presence == Gst.PadPresence.SOMETIMES
+                for t in source.get_pad_template_list()
+            )
+            q = self.add_element(
+                "queue",
+                connect_to_output=source,
+                connect_when_available="video" if dynamic else False,
+                sidechain=True,
+            )
+            if hasattr(compositor, "request_pad_simple"):
+                pad = compositor.request_pad_simple("sink_%u")
+            else:
+                pad = compositor.get_request_pad("sink_%u")
+            q.get_static_pad("src").link(pad)
+            info["pads"].append(pad)
+
+            if grid:
+                self.set_compositor_layout(compositor)
+            return len(info["pads"]) - 1
+
+    def set_compositor_layout(self, compositor, layout=None, columns=None):
+        """Place compositor inputs.  layout is a list of (x, y, width, height) per input, in pixels
+        or, if all are at most 1, as fractions of the output.  Inputs past the end of the list are hidden.
+        Without a layout, inputs are arranged in an even grid, columns wide.
+        These are just pad properties, they apply from the next output frame, nothing restarts."""
+        if isinstance(compositor, int):
+            compositor = elementsByShortId[compositor]
+
+        with self.lock:
+            info = self.compositors[compositor]
+            pads = info["pads"]
+            w, h = info["size"]
+
+            if layout is None:
+                n = len(pads)
+                columns = columns or math.ceil(math.sqrt(n)) or 1
+                rows = math.ceil(n / columns) or 1
+                cw, ch = w // columns, h // rows
+                layout = [
+                    ((i % columns) * cw, (i // columns) * ch, cw, ch) for i in range(n)
+                ]
+            elif all(v <= 1 for rect in layout for v in rect):
+                layout = [(x * w, y * h, rw * w, rh * h) for x, y, rw, rh in layout]
+
+            for i, pad in enumerate(pads):
+                if i < len(layout):
+                    x, y, rw, rh = (int(v) for v in layout[i])
+                    pad.set_property("xpos", x)
+                    pad.set_property("ypos", y)
+                    pad.set_property("width", rw)
+                    pad.set_property("height", rh)
+                    pad.set_property("alpha", 1.0)
+                    pad.set_property("zorder", i)
+                else:
+                    pad.set_property("alpha", 0.0)
+
+    def addCompositorRemote(self, *a, **k):
+        return id(self.add_compositor(*a, **k))
+
+    def publishStreamRemote(self, *a, **k):
+        return id(self.publish_stream(*a, **k))
+
+    def subscribeStreamRemote(self, *a, **k):
+        return id(self.subscribe_stream(*a, **k))
+
+    def get_app_source_stats(self, source):
+        if isinstance(source, int):
+            source = elementsByShortId[source]
+        return source.stats()
+
+    def open_shm_source(self, source, ring_name, framerate=None, max_bytes=None):
+        """Start feeding an appsrc or AppSource from a shared memory ring created by the client.
+        Returns an ID for shm_doorbell and close_shm_source."""
+        if isinstance(source, int):
+            source = elementsByShortId[source]
+
+        if not isinstance(source, AppSource):
+            # A plain appsrc from add_element, it needs flow control so the ring provides backpressure
+            if source not in self.shm_appsources:
+                self.shm_appsources[source] = AppSource(source, framerate, max_bytes)
+                self.appsources.append(self.shm_appsources[source])
+            source = self.shm_appsources[source]
+
+        f = ShmFeeder(source, get_shm_ring().attach(ring_name))
+        elementsByShortId[id(f)] = f
+        self.shm_feeders[id(f)] = f
+        return id(f)
+
+    def shm_doorbell(self, feeder):
+        f = self.shm_feeders.get(feeder)
+        if f:
+            f.doorbell.set()
+
+    def close_shm_source(self, feeder):
+        f = self.shm_feeders.pop(feeder, None)
+        if f:
+            f.close()
+            # A frame it already took goes in before anything from a replacement ring
+            f.thread.join(AppSource.PUSH_TIMEOUT)
+
+    def addPILSource(self, resolution, buffer=1, greyscale=False, framerate=None):
+        """Return a video source object that we can use to put PIL buffers into the stream.
+        Pushes block once buffer frames are queued."""
+        frame_size = resolution[0] * resolution[1] * (1 if greyscale else 3)
+
+        caps = "video/x-raw,width={},height={},format={}".format(
+            resolution[0], resolution[1], "GRAY8" if greyscale else "RGB"
         )
+        if framerate:
+            f = parse_framerate(framerate)
+            caps += ",framerate={}/{}".format(f.numerator, f.denominator)
+
+        appsrc = self.add_element("appsrc", caps=caps, connect_to_output=False)
         self.add_element("videoconvert")
         self.add_element("videoscale")
 
+        s = PILSource(appsrc, greyscale, framerate, frame_size * max(buffer, 1))
+        self.appsources.append(s)
+
         # Start with a blck image to make things prerooll
-        if greyscale:
-            appsrc.emit(
-                "push-buffer",
-                Gst.Buffer.new_wrapped(bytes(resolution[0] * resolution[1])),
-            )
-        else:
-            appsrc.emit(
-                "push-buffer",
-                Gst.Buffer.new_wrapped(bytes(resolution[0] * resolution[1] * 3)),
-            )
+        AppSource.push(s, bytes(frame_size), block=False)
 
-        return PILSource(appsrc, greyscale)
+        return s
 
     def pull_buffer(self, element, timeout=0.1):
-        if not self.appsink:
-            raise RuntimeError("No appsink")
-
         if isinstance(element, int):
             element = elementsByShortId[element]
 
-        sample = self.appsink.emit("try-pull-sample", timeout * 10**9)
-        if not sample:
-            return None
+        appsink = self.appsink
+        if self.elementTypesById.get(id(element)) == "appsink":
+            appsink = element
 
-        buf = sample.get_buffer()
-        sample.get_caps()
+        if not appsink:
+            raise RuntimeError("No appsink")
 
-        return base64.b64encode(buf.extract_dup(0, buf.get_size()))
+        with AppSink(appsink).pull_mapped(timeout) as data:
+            if data is None:
+                return None
+            # Encode straight from the mapped memory
+            return base64.b64encode(data).decode()
 
     def pull_to_file(self, element, fn):
         if isinstance(element, int):
@@ -1129,8 +3550,11 @@ class GStreamerPipeline:
         connectToOutput=None,
         auto_insert_audio_convert=False,
         sidechain=False,
+        live=False,
         **kwargs,
     ):
+        """With live=True the element can be added while the pipeline runs.  If what it connects to
+        already feeds something, it gets inserted in between.  Tees get a new branch."""
         # TODO: remove Legacy hack eventually
         connect_to_output = connect_to_output or connectToOutput
         connect_when_available = connect_when_available or connectWhenAvailable
@@ -1138,7 +3562,7 @@ class GStreamerPipeline:
             if not isinstance(t, str):
                 raise ValueError("Element type must be string")
 
-            e = Gst.ElementFactory.make(t, name)
+            e = registry.make(t, name)
 
             # if t=='appsink':
             #     e.connect("new-sample", self.appsinkhandler, name)
@@ -1179,47 +3603,60 @@ class GStreamerPipeline:
                 if connect_to_output is None:
                     op = [None]
 
-            for connect_to_output in op:
-                # Element doesn't have an input pad, we want this to be usable as a fake source to go after a real source if someone
-                # wants to use it as a effect
-                if t == "audiotestsrc":
-                    connect_to_output = False
-
-                # This could be the first element
-                if self.elements and (connect_to_output is not False):
-                    connect_to_output = connect_to_output or self.elements[-1]
-
-                    # Fakesinks have no output, we automatically don't connect those
-                    if self.elementTypesById[id(connect_to_output)] == "fakesink":
+            if live:
+                # The pipeline may be running, so this is done with pad probes
+                if len(op) > 1:
+                    raise ValueError("Live elements can only connect to one element")
+                up = op[0] if op else False
+                if up is None and self.elements:
+                    up = self.elements[-1]
+                # Ready to take data before anything can reach it
+                e.sync_state_with_parent()
+                if up:
+                    self._link_live(up, e)
+            else:
+                for connect_to_output in op:
+                    # Element doesn't have an input pad, we want this to be usable as a fake source to go after a real source if someone
+                    # wants to use it as a effect
+                    if t == "audiotestsrc":
                         connect_to_output = False
 
-                    # Decodebin doesn't have a pad yet for some awful reason
-                    elif (
-                        self.elementTypesById[id(connect_to_output)] == "decodebin"
-                    ) or connect_when_available:
-                        eid = time.time()
-                        f = linkClosureMaker(
-                            weakref.ref(self),
-                            connect_to_output,
-                            e,
-                            connect_when_available,
-                            eid,
-                        )
+                    # This could be the first element
+                    if self.elements and (connect_to_output is not False):
+                        connect_to_output = connect_to_output or self.elements[-1]
+
+                        # Fakesinks have no output, we automatically don't connect those
+                        if self.elementTypesById[id(connect_to_output)] == "fakesink":
+                            connect_to_output = False
+
+                        # Decodebin doesn't have a pad yet for some awful reason
+                        elif (
+                            self.elementTypesById[id(connect_to_output)] == "decodebin"
+                        ) or connect_when_available:
+                            eid = time.time()
+                            f = linkClosureMaker(
+                                weakref.ref(self),
+                                connect_to_output,
+                                e,
+                                connect_when_available,
+                                eid,
+                            )
 
-                        self.waitingCallbacks[eid] = f
-                        # Dummy 1 param because some have claimed to get segfaults without
-                        connect_to_output.connect("pad-added", f, 1)
-                    else:
-                        try:
-                            link(connect_to_output, e)
-                        except Exception:
-                            if auto_insert_audio_convert:
-                                c = self.add_element(
-                                    "audioconvert", connect_to_output=connect_to_output
-                                )
-                                link(c, e)
-                            else:
-                                raise
+                            self.waitingCallbacks[eid] = f
+                            # Dummy 1 param because some have claimed to get segfaults without
+                            connect_to_output.connect("pad-added", f, 1)
+                        else:
+                            try:
+                                link(connect_to_output, e)
+                            except Exception:
+                                if auto_insert_audio_convert:
+                                    c = self.add_element(
+                                        "audioconvert",
+                                        connect_to_output=connect_to_output,
+                                    )
+                                    link(c, e)
+                                else:
+                                    raise
 
             # Sidechain means don't set this element as the
             # automatic thing that the next entry links to
@@ -1248,6 +3685,196 @@ class GStreamerPipeline:
     def add_elementRemote(self, *a, **k):
         return id(self.add_element(*a, **k))
 
+    def _whenIdle(self, pad, timeout=5):
+        """Block dataflow through pad, waiting till nothing is in flight.
+        Returns the probe id, remove it to let data through again."""
+        blocked = threading.Event()
+
+        def probe(pad, info):
+            blocked.set()
+            # Staying installed keeps the pad blocked
+            return Gst.PadProbeReturn.OK
+
+        probe_id = pad.add_probe(Gst.PadProbeType.IDLE, probe)
+        if not blocked.wait(timeout):
+            pad.remove_probe(probe_id)
+            raise RuntimeError("Timeout waiting for the stream to go idle: " + str(pad))
+        return probe_id
+
+    def _link_live(self, up, e, timeout=5):
+        "Link e after up while data may be flowing"
+        request = [
+            i
+            for i in up.get_pad_template_list()
+            if i.direction == Gst.PadDirection.SRC
+            and i.presence == Gst.PadPresence.REQUEST
+        ]
+        if request or [i for i in up.srcpads if not i.is_linked()]:
+            # New pad, no data in flight on it yet
+            try:
+                link(up, e)
+            except Exception:
+                self._discard_element(e)
+                raise
+            return
+
+        if not up.srcpads:
+            self._discard_element(e)
+            raise ValueError("Nothing to connect to on " + str(up))
+
+        src = up.srcpads[0]
+        probe_id = self._whenIdle(src, timeout)
+        try:
+            down = src.get_peer()
+            src.unlink(down)
+            try:
+                link(src, e)
+                out = e.get_static_pad("src")
+                if not out or not out.link(down) == Gst.PadLinkReturn.OK:
+                    raise RuntimeError("Could not link " + str(e) + " to " + str(down))
+            except Exception:
+                # Put back the link that was there, so the pipeline keeps working
+                if src.is_linked():
+                    src.unlink(src.get_peer())
+                src.link(down)
+                self._discard_element(e)
+                raise
+        finally:
+            src.remove_probe(probe_id)
+
+    def _discard_element(self, e):
+        "Undo adding an element that could not be linked"
+        e.set_state(Gst.State.NULL)
+        self.pipeline.remove(e)
+        self._forget_element(e)
+
+    def _downstream_of(self, element):
+        """Element and everything it feeds, stopping at anything that is also fed
+        from elsewhere, like a mixer shared with other branches"""
+        found = [element]
+        i = 0
+        while i < len(found):
+            for pad in found[i].srcpads:
+                peer = pad.get_peer()
+                if not peer:
+                    continue
+                e = peer.get_parent_element()
+                if e in found:
+                    continue
+                fed_by = [
+                    p.get_peer().get_parent_element()
+                    for p in e.sinkpads
+                    if p.get_peer()
+                ]
+                if all(j in found for j in fed_by):
+                    found.append(e)
+            i += 1
+        return found
+
+    def _forget_element(self, e):
+        for i in (self.elements, self.sidechainElements):
+            if e in i:
+                i.remove(e)
+        for k, v in list(self.namedElements.items()):
+            if v is e:
+                del self.namedElements[k]
+        for k, v in list(elementsByShortId.items()):
+            if v is e:
+                self.elementTypesById.pop(k, None)
+                self.proxies_to_elements.pop(k, None)
+        self.elementTypesById.pop(id(e), None)
+
+    def remove_element(self, element, branch=False, send_eos=True, timeout=5):
+        """Take an element out of the pipeline while it runs.  Whatever fed it gets linked to
+        whatever it fed.  With branch=True, everything downstream of it is removed too.
+
+        With send_eos, data still inside gets drained first, so muxers in a branch being
+        removed can finish their files."""
+        with self.lock:
+            if isinstance(element, int):
+                element = elementsByShortId[element]
+            element = elementsByShortId.get(id(element), element)
+
+            doomed = self._downstream_of(element) if branch else [element]
+            sink = element.sinkpads[0] if element.sinkpads else None
+            up = sink.get_peer() if sink else None
+
+            src = element.srcpads[0] if element.srcpads else None
+            down = None
+            # With nothing upstream, like a source feeding a mixer, there is nothing to relink
+            if src and up and not branch:
+                down = src.get_peer()
+
+            probe_id = self._whenIdle(up, timeout) if up else None
+            try:
+                if send_eos and sink:
+                    self._drain(sink, doomed, src if down else None, timeout)
+
+                # Stopped before unlinking, so nothing pushes into an unlinked pad and errors out
+                for e in doomed:
+                    e.set_state(Gst.State.NULL)
+
+                if up:
+                    up.unlink(sink)
+
+                # Branches being cut off from something that stays, like a shared mixer
+                for e in doomed:
+                    for pad in e.srcpads:
+                        peer = pad.get_peer()
+                        if peer and peer.get_parent_element() not in doomed:
+                            pad.unlink(peer)
+                            if peer is not down:
+                                release_if_requested(peer)
+
+                for e in doomed:
+                    self.pipeline.remove(e)
+                    self._forget_element(e)
+
+                if up:
+                    if down:
+                        if not up.link(down) == Gst.PadLinkReturn.OK:
+                            raise RuntimeError("Could not relink " + str(up))
+                    else:
+                        release_if_requested(up)
+            finally:
+                if probe_id is not None:
+                    up.remove_probe(probe_id)
+
+    def _drain(self, sink, doomed, src, timeout):
+        """Send EOS into sink and wait for it to come out of src, where it is dropped, or
+        reach every sink element in doomed if src is None"""
+        if src:
+            pads = [src]
+        else:
+            pads = [p for e in doomed if not e.srcpads for p in e.sinkpads]
+        if not pads:
+            return
+
+        remaining = [len(pads)]
+        drained = threading.Event()
+        lock = threading.Lock()
+
+        def probe(pad, info):
+            if not info.get_event().type == Gst.EventType.EOS:
+                return Gst.PadProbeReturn.OK
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] <= 0:
+                    drained.set()
+            # Whatever stays in the pipeline must not see this EOS
+            if src:
+                return Gst.PadProbeReturn.DROP
+            return Gst.PadProbeReturn.OK
+
+        probes = [
+            (p, p.add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, probe)) for p in pads
+        ]
+        sink.send_event(Gst.Event.new_eos())
+        if not drained.wait(timeout):
+            logging.warning("Timeout draining before removing elements")
+        for p, i in probes:
+            p.remove_probe(i)
+
     def set_property(self, element, prop, value):
         with self.lock:
             if isinstance(element, int):
@@ -1257,9 +3884,8 @@ class GStreamerPipeline:
                 if not os.path.isfile(value):
                     raise ValueError("No such file: " + value)
 
-            if prop == "caps":
-                value = Gst.Caps(value)
-                self.weakrefs[str(value)] = value
+            if prop == "caps" and isinstance(value, str):
+                value = registry.caps(value)
 
             if isinstance(value, dict):
                 st = Gst.Structure.new_empty("foo")
@@ -1276,10 +3902,77 @@ class GStreamerPipeline:
             if len(prop) > 1:
                 childIndex = int(prop[0])
                 target = element.get_child_by_index(childIndex)
-                target.set_property(prop[1], value)
+                value = registry.coerce(target, prop[1], value)
+                if value is not ALREADY_SET:
+                    target.set_property(prop[1], value)
                 self.weakrefs[str(target) + "fromgetter"] = target
             else:
-                element.set_property(prop[0], value)
+                # A direct set means the caller wants to take over from any automation
+                if self.control_bindings:
+                    self._clear_control_binding(element, prop[0])
+                value = registry.coerce(element, prop[0], value)
+                if value is not ALREADY_SET:
+                    element.set_property(prop[0], value)
+
+    def list_elements(self):
+        "Names of every element type this process can make"
+        return registry.list_elements()
+
+    def describe_element(self, name):
+        "Class, pad templates and properties of an element type"
+        return registry.describe(name)
+
+    def _clear_control_binding(self, element, prop):
+        b = self.control_bindings.pop((id(element), prop), None)
+        if b:
+            element.remove_control_binding(b[0])
+
+    def automate_property(self, element, prop, points, mode="linear"):
+        """Attach a GstController interpolation curve to a property, so the streaming thread applies it
+        per buffer with no further RPC calls.  points is a list of (seconds, value), with times relative
+        to the current stream position.  Replaces any automation already on that property."""
+        GstController = get_gst_controller()
+
+        modes = {
+            "linear": GstController.InterpolationMode.LINEAR,
+            "cubic": GstController.InterpolationMode.CUBIC_MONOTONIC,
+            "none": GstController.InterpolationMode.NONE,
+        }
+        if mode not in modes:
+            raise ValueError("Unknown interpolation mode: " + str(mode))
+
+        with self.lock:
+            if isinstance(element, int):
+                element = elementsByShortId[element]
+            prop = prop.replace("_", "-")
+
+            self._clear_control_binding(element, prop)
+
+            cs = GstController.InterpolationControlSource()
+            cs.set_property("mode", modes[mode])
+            # Absolute, so points are real property values and not 0 to 1
+            binding = GstController.DirectControlBinding.new_absolute(element, prop, cs)
+            element.add_control_binding(binding)
+
+            # Control points are in stream time, which is what elements sync to
+            ok, base = self.pipeline.query_position(Gst.Format.TIME)
+            if not ok or base < 0:
+                base = 0
+
+            for t, v in points:
+                cs.set(base + int(t * Gst.SECOND), float(v))
+
+            self.control_bindings[(id(element), prop)] = (binding, cs)
+
+    def fade_property(self, element, prop, target, duration, mode="linear"):
+        "Ramp a property from where it is now to target over duration seconds"
+        with self.lock:
+            if isinstance(element, int):
+                element = elementsByShortId[element]
+            current = element.get_property(prop.replace("_", "-"))
+            self.automate_property(
+                element, prop, [(0, current), (duration, target)], mode
+            )
 
     def get_property(self, element, prop):
         with self.lock:
@@ -1304,48 +3997,61 @@ gstp = None
 ppid = os.getppid()
 
 
-def stop_with_thread(pipeline: GStreamerPipeline):
-    complete = [False]
-
-    def f():
-        gstp.stop()
-        complete[0] = True
-
-    t = threading.Thread(target=f, daemon=True)
+def stop_with_thread(pipeline: GStreamerPipeline, timeout: float = SHUTDOWN_TIMEOUT):
+    """Stop in a thread, and if that hangs past timeout, kill the process.
+    The kernel frees device handles on exit, so they are free within timeout either way."""
+    t = threading.Thread(target=pipeline.stop, daemon=True)
     t.start()
-    for i in range(100):
-        if complete[0]:
-            break
-        time.sleep(0.1)
-    if not complete[0]:
+    t.join(timeout)
+    if t.is_alive():
         os.kill(os.getpid(), 9)
 
 
 def main():
     global gstp
 
-    gstp = GStreamerPipeline()
+    _wake.extend(os.pipe())
+    for i in _wake:
+        os.set_blocking(i, False)
+    # The handler does nothing, the wakeup fd is what gets the main loop going
+    signal.signal(PDEATHSIG, lambda *a: None)
+    signal.set_wakeup_fd(_wake[1])
+    set_parent_death_signal(PDEATHSIG)
+
+    poller = select.poll()
+    poller.register(_wake[0], select.POLLIN)
+    pidfd = open_pidfd(ppid)
+    if pidfd is not None:
+        poller.register(pidfd, select.POLLIN)
+
+    # Constructor args from the client, like system_time
+    config = json.loads(sys.argv[1]) if len(sys.argv) > 1 else {}
+    gstp = GStreamerPipeline(**config)
+    mark_startup("pipeline")
     # Replace the dummy we put there for the linter
     rpc[0] = jsonrpyc.RPC(target=gstp, daemon=True)
+    mark_startup("ready")
+    # Tells the client it can start sending commands
+    call_rpc_if_exists("_on_ready", [startup_profile])
 
     while 1:
         try:
-            time.sleep(1)
+            # Parent death, the death signal and stop() all wake this right away,
+            # the timeout is only a fallback where none of those are available.
+            poller.poll(1000)
+            try:
+                os.read(_wake[0], 4096)
+            except BlockingIOError:
+                pass
 
-            if (not check_pid(ppid)) or stopflag[0]:
+            # Parent might have died before the prctl, that would be caught here
+            if (not parent_alive()) or stopflag[0]:
                 try:
                     stop_with_thread(gstp)
                 except Exception:  # noqa
                     pass
                 sys.exit()
 
-            if not os.getppid() == ppid:
-                try:
-                    stop_with_thread(gstp)
-                except Exception:  # noqa
-                    pass
-                return
-
         except Exception:  # noqa
             if os.path.exists("/dev/shm/"):
                 with open("/dev/shm/iceflow_server_error.txt", "w") as f:
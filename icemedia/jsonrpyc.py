@@ -258,6 +258,10 @@ class RPC(object):
         self._callbacks = {}
         self._results = {}
 
+        # Notifications may be sent from GStreamer streaming threads while
+        # the watchdog is writing a response, lines must not interleave.
+        self._write_lock = threading.Lock()
+
         # create and optionall start the watchdog
         kwargs["start"] = watch
         kwargs.setdefault("daemon", target is None)
@@ -455,8 +459,9 @@ class RPC(object):
         """
         Writes a string *s* to the output stream.
         """
-        self.stdout.write(bytearray(s + "\n", "utf-8"))
-        self.stdout.flush()
+        with self._write_lock:
+            self.stdout.write(bytearray(s + "\n", "utf-8"))
+            self.stdout.flush()
 
 
 class Watchdog(threading.Thread):
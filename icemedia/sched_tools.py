@@ -0,0 +1,109 @@
+# SPDX-FileCopyrightText: Copyright Daniel Dunn
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+"""Linux per thread scheduling, realtime policy, nice and CPU affinity,
+and reading back per thread CPU use from /proc.  Everything fails soft without privileges."""
+
+from __future__ import annotations
+
+import logging
+import os
+
+log = logging.getLogger("IceFlow_sched")
+
+POLICIES = {
+    "other": getattr(os, "SCHED_OTHER", None),
+    "fifo": getattr(os, "SCHED_FIFO", None),
+    "rr": getattr(os, "SCHED_RR", None),
+    "batch": getattr(os, "SCHED_BATCH", None),
+    "idle": getattr(os, "SCHED_IDLE", None),
+}
+POLICY_NAMES = {v: k for k, v in POLICIES.items() if v is not None}
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+# Only complain once per kind of failure, a pipeline can have dozens of threads
+_warned: set[str] = set()
+
+
+def _warn_once(kind: str, e: Exception):
+    if kind not in _warned:
+        _warned.add(kind)
+        log.warning(f"Could not set {kind}, continuing without it: {e}")
+
+
+def apply(
+    tid: int,
+    policy: str | None = None,
+    priority: int = 0,
+    nice: int | None = None,
+    cpus: list[int] | None = None,
+) -> list[str]:
+    """Apply what can be applied to a thread (or process) id.
+    Returns the names of settings that failed, like ["policy"] without CAP_SYS_NICE."""
+    failed = []
+
+    if policy:
+        try:
+            os.sched_setscheduler(tid, POLICIES[policy], os.sched_param(priority))
+        except (OSError, AttributeError, TypeError) as e:
+            _warn_once("policy", e)
+            failed.append("policy")
+
+    if nice is not None:
+        try:
+            # Nice is per thread on Linux, despite the name
+            os.setpriority(os.PRIO_PROCESS, tid, nice)
+        except (OSError, AttributeError) as e:
+            _warn_once("nice", e)
+            failed.append("nice")
+
+    if cpus:
+        try:
+            os.sched_setaffinity(tid, cpus)
+        except (OSError, AttributeError) as e:
+            _warn_once("affinity", e)
+            failed.append("cpus")
+
+    return failed
+
+
+def thread_ids(pid: int | str = "self") -> list[int]:
+    try:
+        return [int(i) for i in os.listdir(f"/proc/{pid}/task")]
+    except FileNotFoundError:
+        return []
+
+
+def thread_stat(tid: int, pid: int | str = "self") -> dict | None:
+    "Name, CPU time in seconds, last CPU, policy, priority, nice and affinity of one thread"
+    try:
+        with open(f"/proc/{pid}/task/{tid}/stat") as f:
+            stat = f.read()
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+
+    # The name is in parens and may itself contain spaces and parens
+    name = stat[stat.index("(") + 1 : stat.rindex(")")]
+    fields = stat[stat.rindex(")") + 2 :].split()
+
+    try:
+        affinity = sorted(os.sched_getaffinity(tid))
+    except OSError:
+        affinity = []
+
+    policy = int(fields[38])
+    return {
+        "tid": tid,
+        "name": name,
+        "cpu_time": (int(fields[11]) + int(fields[12])) / CLOCK_TICKS,
+        "last_cpu": int(fields[36]),
+        "policy": POLICY_NAMES.get(policy, str(policy)),
+        "priority": int(fields[37]),
+        "nice": int(fields[16]),
+        "affinity": affinity,
+    }
+
+
+def thread_stats(pid: int | str = "self") -> list[dict]:
+    return [i for i in (thread_stat(t, pid) for t in thread_ids(pid)) if i]
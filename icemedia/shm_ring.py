@@ -0,0 +1,128 @@
+# SPDX-FileCopyrightText: Copyright Daniel Dunn
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+"""Single producer, single consumer ring of fixed size slots in shared memory.
+Used to move frames between the iceflow client and server without going through JSON."""
+
+from __future__ import annotations
+
+import struct
+import sys
+import time
+from multiprocessing import shared_memory
+
+# magic, slot count, slot size, write sequence, read sequence
+HEADER = struct.Struct("<IIQQQ")
+MAGIC = 0x1CEF10
+LENGTH = struct.Struct("<Q")
+
+
+class ShmRing:
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool):
+        self.shm = shm
+        self.owner = owner
+        self.name = shm.name
+        magic, self.slots, self.slot_size, _, _ = HEADER.unpack_from(shm.buf, 0)
+        if magic != MAGIC:
+            raise ValueError("Not an iceflow ring: " + shm.name)
+
+        self._data_start = HEADER.size + LENGTH.size * self.slots
+
+    @classmethod
+    def create(cls, slot_size: int, slots: int = 4) -> ShmRing:
+        size = HEADER.size + (LENGTH.size + slot_size) * slots
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        HEADER.pack_into(shm.buf, 0, MAGIC, slots, slot_size, 0, 0)
+        return cls(shm, True)
+
+    @classmethod
+    def attach(cls, name: str) -> ShmRing:
+        if sys.version_info >= (3, 13):
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            shm = shared_memory.SharedMemory(name=name)
+            # Otherwise the resource tracker unlinks it when this process exits,
+            # out from under the owner.
+            from multiprocessing import resource_tracker
+
+            resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore
+        return cls(shm, False)
+
+    def _seqs(self):
+        return HEADER.unpack_from(self.shm.buf, 0)[3:]
+
+    def _slot(self, seq: int) -> int:
+        return self._data_start + (seq % self.slots) * self.slot_size
+
+    def _length_offset(self, seq: int) -> int:
+        return HEADER.size + LENGTH.size * (seq % self.slots)
+
+    def queued(self) -> int:
+        "Number of slots written but not yet consumed"
+        w, r = self._seqs()
+        return w - r
+
+    def write(self, data, timeout: float | None = None) -> bool:
+        """Copy data into the next free slot, waiting up to timeout for the reader to free one.
+        Returns False on timeout."""
+        data = memoryview(data).cast("B")
+        if data.nbytes > self.slot_size:
+            raise ValueError(
+                f"{data.nbytes} bytes does not fit in a {self.slot_size} byte slot"
+            )
+
+        t = time.monotonic()
+        delay = 0.0002
+        while True:
+            w, r = self._seqs()
+            if w - r < self.slots:
+                break
+            if timeout is not None and time.monotonic() - t > timeout:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 0.005)
+
+        start = self._slot(w)
+        self.shm.buf[start : start + data.nbytes] = data
+        LENGTH.pack_into(self.shm.buf, self._length_offset(w), data.nbytes)
+
+        # Publishing the sequence number last is what hands the slot to the reader
+        struct.pack_into("<Q", self.shm.buf, HEADER.size - 16, w + 1)
+        return True
+
+    def wait_empty(self, timeout: float | None = None) -> bool:
+        "Wait up to timeout for the reader to consume every written slot.  Returns False on timeout."
+        t = time.monotonic()
+        delay = 0.0002
+        while self.queued():
+            if timeout is not None and time.monotonic() - t > timeout:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 0.005)
+        return True
+
+    def peek(self) -> memoryview | None:
+        "View of the oldest unread slot, or None.  Valid until advance()"
+        w, r = self._seqs()
+        if w == r:
+            return None
+        start = self._slot(r)
+        (n,) = LENGTH.unpack_from(self.shm.buf, self._length_offset(r))
+        return self.shm.buf[start : start + n]
+
+    def advance(self):
+        "Release the slot returned by peek() back to the writer"
+        _, r = self._seqs()
+        struct.pack_into("<Q", self.shm.buf, HEADER.size - 8, r + 1)
+
+    def close(self):
+        try:
+            self.shm.close()
+        except BufferError:
+            # A view is still alive somewhere, it will get closed at GC time
+            pass
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
@@ -17,6 +17,10 @@ except Exception:
 
 from tests import testJack
 from tests import testGstStability
+from tests import testSyncGroup
+from tests import testStandby
+from tests import testStreams
+from tests import testRecorder
 import unittest
 import scullery.workers
 
@@ -28,3 +32,11 @@ unittest.main(testJack, exit=False)
 
 
 unittest.main(testGstStability, exit=False)
+
+unittest.main(testSyncGroup, exit=False)
+
+unittest.main(testStandby, exit=False)
+
+unittest.main(testStreams, exit=False)
+
+unittest.main(testRecorder, exit=False)
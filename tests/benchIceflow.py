@@ -0,0 +1,147 @@
+"""Benchmarks for iceflow.  Not part of the test suite, run with python -m tests.benchIceflow
+Needs GStreamer and the base/good plugins installed."""
+
+import time
+import tracemalloc
+
+FRAMES = 200
+
+
+def bench_buffer_copies():
+    "Heap use when pulling frames with extract_dup vs mapping, and BufferPool allocation counts"
+    from icemedia import iceflow_server
+
+    p = iceflow_server.GStreamerPipeline()
+    p.add_element("videotestsrc", is_live=False)
+    p.add_element("capsfilter", caps="video/x-raw,width=1280,height=720")
+    cap = p.add_pil_capture(buffer=4)
+    p.start()
+
+    def run(pull):
+        # Warm up so the pool has allocated its slots
+        for i in range(10):
+            pull()
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        t = time.perf_counter()
+        for i in range(FRAMES):
+            pull()
+        elapsed = time.perf_counter() - t
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return elapsed / FRAMES, peak - base
+
+    def dup():
+        sample = cap.pull_sample(1)
+        buf = sample.get_buffer()
+        return buf.extract_dup(0, buf.get_size())
+
+    pool = iceflow_server.BufferPool(2)
+
+    def pooled():
+        return cap.pull_array(pool, 1)
+
+    def mapped():
+        with cap.pull_mapped(1) as a:
+            return a.shape
+
+    for name, f in (("extract_dup", dup), ("map+pool", pooled), ("map only", mapped)):
+        per_frame, peak = run(f)
+        print(
+            f"{name:12} {per_frame * 1000:7.3f}ms/frame  "
+            f"peak Python heap over {FRAMES} frames: {peak / 1024:.0f}KiB"
+        )
+    print(f"Pool slot allocations: {pool.allocations}")
+    p.stop()
+
+
+def bench_state_changes(runs=20):
+    "Time from start() to PLAYING and from stop() to NULL, in process and through the client"
+    from icemedia import iceflow, iceflow_server
+
+    def report(name, samples):
+        samples = sorted(samples)
+        print(
+            f"{name:28} median {samples[len(samples) // 2] * 1000:7.2f}ms  "
+            f"max {samples[-1] * 1000:7.2f}ms"
+        )
+
+    for name, cls in (
+        ("server", iceflow_server.GStreamerPipeline),
+        ("client", iceflow.GStreamerPipeline),
+    ):
+        starts = []
+        stops = []
+        for i in range(runs):
+            p = cls()
+            p.add_element("audiotestsrc")
+            p.add_element("fakesink")
+            t = time.perf_counter()
+            p.start()
+            starts.append(time.perf_counter() - t)
+            t = time.perf_counter()
+            p.stop()
+            stops.append(time.perf_counter() - t)
+        report(f"{name} start to PLAYING", starts)
+        report(f"{name} stop to NULL", stops)
+
+
+def bench_startup(runs=10):
+    """Time from spawning the server process to it saying it's ready, with the server's own
+    breakdown.  Regressions here usually mean something heavy got imported at the top level."""
+    from icemedia import iceflow
+
+    samples = {}
+    for i in range(runs):
+        p = iceflow.GStreamerPipeline()
+        for step, t in p.startup_profile.items():
+            samples.setdefault(step, []).append(t)
+        p.stop()
+
+    for step, t in samples.items():
+        t = sorted(t)
+        print(
+            f"startup {step:12} median {t[len(t) // 2] * 1000:7.2f}ms  "
+            f"max {t[-1] * 1000:7.2f}ms"
+        )
+
+
+def bench_push_shm(seconds=5):
+    """Sustained rate of 1080p RGB frames pushed from the client with push_array,
+    through the shared memory ring into an appsrc and a fakesink.  The target is 30fps."""
+    import numpy
+    from icemedia import iceflow
+
+    p = iceflow.GStreamerPipeline()
+    src = p.add_app_source(
+        "video/x-raw,format=RGB,width=1920,height=1080,framerate=30/1", framerate=30
+    )
+    p.add_element("fakesink", sync=False)
+    p.start()
+
+    frame = numpy.zeros((1080, 1920, 3), dtype=numpy.uint8)
+    # Warm up, the first push creates the ring
+    for i in range(10):
+        src.push_array(frame)
+
+    frames = 0
+    t = time.perf_counter()
+    while time.perf_counter() - t < seconds:
+        if src.push_array(frame, timeout=5):
+            frames += 1
+    elapsed = time.perf_counter() - t
+
+    stats = p.rpc_call("get_app_source_stats", args=(src.id,), block=0.0001, timeout=10)
+    print(
+        f"push_array 1080p RGB  {frames / elapsed:7.1f}fps sustained  "
+        f"dropped {stats['dropped']}"
+    )
+    p.stop()
+
+
+if __name__ == "__main__":
+    bench_buffer_copies()
+    bench_state_changes()
+    bench_startup()
+    bench_push_shm()
@@ -0,0 +1,10 @@
+import icemedia.iceflow
+
+
+class TonePlayer(icemedia.iceflow.GstreamerPipeline):
+    "Plays a test tone in real time without needing a sound card"
+
+    def __init__(self):
+        icemedia.iceflow.GstreamerPipeline.__init__(self, realtime=False)
+        self.add_element("audiotestsrc", is_live=False)
+        self.add_element("fakesink", sync=True)
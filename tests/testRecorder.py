@@ -0,0 +1,46 @@
+import os
+import tempfile
+import time
+import unittest
+import icemedia.iceflow
+
+
+class Camera(icemedia.iceflow.GstreamerPipeline):
+    def __init__(self):
+        icemedia.iceflow.GstreamerPipeline.__init__(self, realtime=False)
+        self.add_element("videotestsrc", is_live=True)
+        self.add_element(
+            "capsfilter", caps="video/x-raw,width=320,height=240,framerate=30/1"
+        )
+        self.recorder = self.add_pretrigger_recorder(pre_roll=2, post_roll=1)
+        self.add_element("fakesink")
+
+
+class TestRecorder(unittest.TestCase):
+    def test_pre_and_post_roll(self):
+        p = Camera()
+        fn = os.path.join(tempfile.mkdtemp(), "motion.mkv")
+        try:
+            p.start()
+            time.sleep(3)
+            # The ring holds about pre_roll, never everything since the start
+            self.assertGreater(p.recorder.stats()["dropped_gops"], 0)
+
+            t = time.monotonic()
+            p.recorder.trigger(fn)
+            time.sleep(1)
+            p.recorder.release()
+            self.assertEqual(p.recorder.finished.get(timeout=10), fn)
+            print(
+                f"Pre-trigger recording done {time.monotonic() - t:.2f}s after trigger"
+            )
+
+            self.assertGreater(os.path.getsize(fn), 0)
+            stats = p.recorder.stats()
+            self.assertEqual(stats["recordings"], 1)
+            self.assertFalse(stats["recording"])
+
+            # Nothing restarted, the main pipeline kept going
+            self.assertTrue(p.isActive())
+        finally:
+            p.stop()
@@ -0,0 +1,35 @@
+import os
+import signal
+import time
+import unittest
+from tests.fixtures import TonePlayer
+
+
+class TestStandby(unittest.TestCase):
+    def test_kill_primary(self):
+        "Chaos test, kill the primary process and measure the gap before the standby plays"
+        p = TonePlayer()
+        try:
+            p.enable_standby()
+            p.start()
+            time.sleep(2)
+
+            killed_at = time.monotonic()
+            os.kill(p.worker.pid, signal.SIGKILL)
+
+            for i in range(100):
+                if p.recovery_stats:
+                    break
+                time.sleep(0.05)
+            total = time.monotonic() - killed_at
+
+            gap = p.recovery_stats[-1]["seconds"]
+            self.assertTrue(p.recovery_stats[-1]["kind"].startswith("failover"))
+            print(f"Failover gap: {gap * 1000:.1f}ms, from kill: {total * 1000:.1f}ms")
+            # Kill to play depends on how loaded the machine is, so it is only reported
+            self.assertLess(gap, 0.25)
+
+            # Picked up where the primary should have been, not from the start
+            self.assertGreater(p.getPosition(), 1.5)
+        finally:
+            p.stop()
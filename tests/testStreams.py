@@ -0,0 +1,52 @@
+import time
+import unittest
+import icemedia.iceflow
+
+
+class Camera(icemedia.iceflow.GstreamerPipeline):
+    def __init__(self):
+        icemedia.iceflow.GstreamerPipeline.__init__(self, realtime=False)
+        self.add_element("videotestsrc", is_live=True)
+        self.add_element("capsfilter", caps="video/x-raw,width=320,height=240")
+        self.publish_stream("iceflow_test_camera")
+
+
+class Viewer(icemedia.iceflow.GstreamerPipeline):
+    def __init__(self):
+        icemedia.iceflow.GstreamerPipeline.__init__(self, realtime=False)
+        self.reconnects = 0
+        self.subscribe_stream("iceflow_test_camera")
+        self.add_element("videoconvert")
+        self.add_element("fakesink", sync=False)
+
+    def on_stream_reconnect(self, name):
+        self.reconnects += 1
+
+
+class TestStreams(unittest.TestCase):
+    def test_publisher_restart(self):
+        camera = Camera()
+        camera.start()
+        viewers = [Viewer(), Viewer()]
+        try:
+            for i in viewers:
+                i.start()
+            time.sleep(1)
+
+            # One publisher feeds both, and they survive it going away and coming back
+            camera.stop()
+            time.sleep(0.5)
+            camera = Camera()
+            camera.start()
+
+            for i in range(40):
+                if all(v.reconnects for v in viewers):
+                    break
+                time.sleep(0.1)
+            for v in viewers:
+                self.assertEqual(v.reconnects, 1)
+                self.assertTrue(v.isActive())
+        finally:
+            for i in viewers:
+                i.stop()
+            camera.stop()
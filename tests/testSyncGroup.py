@@ -0,0 +1,31 @@
+import time
+import unittest
+import icemedia.iceflow
+from tests.fixtures import TonePlayer
+
+
+class TestSyncGroup(unittest.TestCase):
+    def test_offset(self):
+        group = icemedia.iceflow.SyncGroup()
+        players = [TonePlayer() for i in range(3)]
+        try:
+            for i in players:
+                group.add(i)
+            group.start()
+            time.sleep(2)
+
+            offsets = group.get_offsets()
+            spread = max(offsets) - min(offsets)
+            print(f"Inter-pipeline offset: {spread * 1000:.3f}ms")
+            self.assertLess(spread, 0.001)
+
+            # Late joiners land at the group position too
+            late = TonePlayer()
+            players.append(late)
+            group.add(late)
+            time.sleep(1)
+            offsets = group.get_offsets()
+            self.assertLess(max(offsets) - min(offsets), 0.001)
+        finally:
+            for i in reversed(players):
+                i.stop()